@@ -0,0 +1,592 @@
+# benchmark.py - hand-run throughput benchmarks against local fake servers
+#
+#   python benchmark.py send [--rows N] [--accounts N] [--smtp-latency MS]
+#   python benchmark.py storage [--rows N]
+#   python benchmark.py ingest [--rows N] [--accounts N]
+#   python benchmark.py sync [--rows N] [--accounts N] [--imap-latency MS]
+#   python benchmark.py pixel [--rows N] [--requests N] [--concurrency N]
+#   python benchmark.py dashboard [--rows N] [--repeat N]
+#   python benchmark.py all [--output results.json] [--compare baseline.json]
+#
+# Everything runs in a scratch directory with its own database; nothing real is contacted.
+# --output writes the results plus the git revision and environment as one JSON document;
+# --compare checks them against an earlier --output file and exits 1 on a regression.
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import platform
+import random
+import re
+import select
+import smtplib
+import socketserver
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough ESMTP for smtplib: EHLO, AUTH PLAIN, MAIL/RCPT/DATA, NOOP, RSET, QUIT."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        self.reply("220 fake.smtp ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line.split(b" ", 1)[0].strip().upper()
+            if verb in (b"EHLO", b"HELO"):
+                self.wfile.write(b"250-fake.smtp\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n")
+            elif verb == b"AUTH":
+                self.reply("235 2.7.0 authenticated")
+            elif verb == b"DATA":
+                self.reply("354 end with <CRLF>.<CRLF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                if server.latency:
+                    time.sleep(server.latency)
+                with server.lock:
+                    server.messages += 1
+                self.reply("250 2.0.0 queued")
+            elif verb == b"QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 ok")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0):
+        super().__init__(("127.0.0.1", 0), FakeSMTPHandler)
+        self.latency = latency
+        self.messages = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    """Just enough IMAP4rev1 for main.AsyncIMAPClient: LOGIN, SELECT, UID SEARCH/FETCH, IDLE, LOGOUT.
+
+    Every login sees the same mailbox, so N accounts sync N copies of it.
+    """
+
+    SEARCH_RE = re.compile(r'UID (\d+):\*')
+    HEADER_ITEM_RE = re.compile(r'BODY(?:\.PEEK)?(\[HEADER\.FIELDS \([^)]*\)\])')
+    PARTIAL_RE = re.compile(r'<0\.(\d+)>')
+
+    def reply(self, data):
+        self.wfile.write(data if isinstance(data, bytes) else data.encode())
+
+    def handle(self):
+        server = self.server
+        self.reply("* OK fake.imap ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, command, *rest = line.decode().strip().split(" ", 2)
+            command = command.upper()
+            rest = rest[0] if rest else ""
+            if command in ("UID", "SELECT") and server.latency:
+                time.sleep(server.latency)
+            if command == "LOGIN" or command == "NOOP":
+                self.reply(f"{tag} OK done\r\n")
+            elif command == "SELECT":
+                self.reply(f"* {len(server.mailbox)} EXISTS\r\n* OK [UIDVALIDITY {server.uidvalidity}] ok\r\n"
+                           f"{tag} OK [READ-WRITE] done\r\n")
+            elif command == "IDLE":
+                self.reply("+ idling\r\n")
+                while not select.select([self.connection], [], [], 0.5)[0]:
+                    pass
+                self.rfile.readline()
+                self.reply(f"{tag} OK IDLE terminated\r\n")
+            elif command == "UID" and rest.upper().startswith("SEARCH"):
+                low = int(self.SEARCH_RE.search(rest).group(1))
+                uids = [uid for uid, _, _ in server.mailbox if uid >= low] or [server.mailbox[-1][0]]
+                self.reply(f"* SEARCH {' '.join(map(str, uids))}\r\n{tag} OK done\r\n")
+            elif command == "UID" and rest.upper().startswith("FETCH"):
+                self.fetch(tag, rest.split(" ", 2)[1], rest.split(" ", 2)[2])
+            elif command == "LOGOUT":
+                self.reply(f"* BYE\r\n{tag} OK done\r\n")
+                return
+            else:
+                self.reply(f"{tag} BAD unsupported\r\n")
+
+    def fetch(self, tag, uid_set, items):
+        wanted = set()
+        for part in uid_set.split(","):
+            low, _, high = part.partition(":")
+            wanted.update(range(int(low), int(high or low) + 1))
+        header_item = "BODY" + self.HEADER_ITEM_RE.search(items).group(1)
+        partial = self.PARTIAL_RE.search(items)
+        chunks = []
+        for seq, (uid, header, body) in enumerate(self.server.mailbox, 1):
+            if uid not in wanted:
+                continue
+            body = body[:int(partial.group(1))] if partial else body
+            body_item = "BODY[TEXT]<0>" if partial else "BODY[TEXT]"
+            chunks.append(f"* {seq} FETCH (UID {uid} {header_item} {{{len(header)}}}\r\n".encode() + header
+                          + f" {body_item} {{{len(body)}}}\r\n".encode() + body + b")\r\n")
+        chunks.append(f"{tag} OK done\r\n".encode())
+        self.reply(b"".join(chunks))
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailbox, latency=0.0):
+        super().__init__(("127.0.0.1", 0), FakeIMAPHandler)
+        self.mailbox = mailbox  # list of (uid, header bytes, body bytes)
+        self.uidvalidity = 1
+        self.latency = latency
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+def make_mailbox(messages, reply_every=10):
+    """Synthetic inbox; every reply_every-th message replies to a seeded sent email (see seed_sent_emails)."""
+    mailbox = []
+    for i in range(messages):
+        header = (f"From: Lead {i} <lead{i}@example.com>\r\nSubject: Re: Quick question {i}\r\n"
+                  f"Message-ID: <in{i}@example.com>\r\nDate: Mon, 1 Jan 2024 10:00:00 +0000\r\n")
+        if i % reply_every == 0:
+            header += f"In-Reply-To: <bench-{i}@example.com>\r\nReferences: <bench-{i}@example.com>\r\n"
+        body = f"Thanks for reaching out, {i}.\r\n" + "Sounds interesting, tell me more.\r\n" * 100
+        mailbox.append((i + 1, (header + "\r\n").encode(), body.encode()))
+    return mailbox
+
+
+def load_main(workdir):
+    """Import main.py against a scratch database in workdir."""
+    os.chdir(workdir)
+    for name in ("templates", "pixel.png"):
+        os.symlink(os.path.join(ROOT, name), name)
+    sys.path.insert(0, ROOT)
+    # The fake server speaks plain SMTP on loopback; the pool normally opens SMTP_SSL
+    smtplib.SMTP_SSL = smtplib.SMTP
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main
+        main.init_db()
+    return main
+
+
+def queue_emails(main, rows):
+    import db
+    past = datetime.utcnow() - timedelta(minutes=1)
+    body = "<p>Hi there,</p>" + "<p>Just following up on our conversation about the project.</p>" * 20
+    digest = db.body_hash(body)
+    with sqlite3.connect(main.DB_PATH) as conn:
+        conn.execute("UPDATE emails SET sent_at=? WHERE sent_at IS NULL", (past,))
+        db.store_bodies(conn, [(digest, body)])
+        campaign_id = conn.execute("INSERT INTO campaigns (name) VALUES ('benchmark')").lastrowid
+        conn.executemany('''INSERT INTO emails (uid, email, addr_hash, subject, body_hash, next_send_time, campaign_id)
+                              VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                         [(str(uuid.uuid4()), f"lead{i}@example.com", db.address_hash(f"lead{i}@example.com"),
+                           f"Quick question {i}", digest, past, campaign_id)
+                          for i in range(rows)])
+        conn.commit()
+
+
+def drain_queue(main, smtp, rows):
+    """Run the sender until `rows` more messages reached the fake server. Returns seconds taken."""
+    target = smtp.messages + rows
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        while smtp.messages < target:
+            main.send_next_email()
+    return time.perf_counter() - started
+
+
+def bench_send(args):
+    smtp = FakeSMTPServer(latency=args.smtp_latency / 1000)
+    main = load_main(tempfile.mkdtemp(prefix="bench-"))
+    main.MIN_WAIT_MINUTES = main.MAX_WAIT_MINUTES = 0
+    main.SEND_PER_HOST_LIMIT = args.accounts
+    with sqlite3.connect(main.DB_PATH) as conn:
+        conn.executemany("INSERT INTO accounts (email, smtp_host, smtp_port, smtp_user, smtp_pass, daily_limit) VALUES (?, ?, ?, ?, ?, ?)",
+                         [(f"sender{i}@example.com", "127.0.0.1", smtp.port, "user", "pass", 10 ** 9)
+                          for i in range(args.accounts)])
+        conn.commit()
+    main.account_quotas.reload()
+
+    results = []
+    # Warm up the SMTP pool so both runs reuse logged-in sessions
+    queue_emails(main, args.accounts)
+    drain_queue(main, smtp, args.accounts)
+
+    queue_emails(main, args.rows)
+    elapsed = drain_queue(main, smtp, args.rows)
+    results.append({"benchmark": "send", "mode": "render at send time", "rows": args.rows,
+                    "seconds": round(elapsed, 3), "per_second": round(args.rows / elapsed, 1)})
+
+    queue_emails(main, args.rows)
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.prerender_due_emails()
+    render_elapsed = time.perf_counter() - started
+    elapsed = drain_queue(main, smtp, args.rows)
+    results.append({"benchmark": "send", "mode": "pre-rendered", "rows": args.rows,
+                    "seconds": round(elapsed, 3), "per_second": round(args.rows / elapsed, 1),
+                    "prerender_seconds": round(render_elapsed, 3)})
+    return results
+
+
+def add_accounts(main, count, smtp_port=465, imap_port=None, daily_limit=10 ** 9):
+    with sqlite3.connect(main.DB_PATH) as conn:
+        conn.executemany('''INSERT INTO accounts (email, smtp_host, smtp_port, smtp_user, smtp_pass,
+                                                 imap_host, imap_port, imap_user, imap_pass, daily_limit)
+                              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                         [(f"sender{i}@example.com", "127.0.0.1", smtp_port, "user", "pass",
+                           "127.0.0.1" if imap_port else None, imap_port, f"sender{i}", "pass", daily_limit)
+                          for i in range(count)])
+        conn.commit()
+
+
+def seed_sent_emails(main, rows, campaigns=10, batch_size=50000):
+    """Bulk-load `rows` already-sent emails over `campaigns` campaigns (uids bench-0..bench-N,
+    Message-IDs <bench-N@example.com>), every third one opened, plus matching campaign_stats."""
+    import db
+    started = time.perf_counter()
+    body = "<p>Hi there,</p>" + "<p>Just following up on our conversation about the project.</p>" * 20
+    digest = db.body_hash(body)
+    sent_at = datetime.utcnow() - timedelta(days=1)
+    with sqlite3.connect(main.DB_PATH) as conn:
+        db.store_bodies(conn, [(digest, body)])
+        campaign_ids = [conn.execute("INSERT INTO campaigns (name) VALUES (?)", (f"benchmark {n}",)).lastrowid
+                        for n in range(campaigns)]
+        for offset in range(0, rows, batch_size):
+            conn.executemany('''INSERT INTO emails (uid, email, addr_hash, subject, body_hash, campaign_id,
+                                                   sent_at, account_email, message_id, opened, replied)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                             [(f"bench-{i}", f"lead{i}@example.com", db.address_hash(f"lead{i}@example.com"),
+                               f"Quick question {i}", digest, campaign_ids[i % campaigns], sent_at,
+                               "sender0@example.com", f"bench-{i}@example.com", int(i % 3 == 0), 0)
+                              for i in range(offset, min(offset + batch_size, rows))])
+        db.rebuild_campaign_stats(conn)
+        conn.commit()
+    return time.perf_counter() - started
+
+
+def bench_ingest(args):
+    """Upload a lead CSV and time the /select import job that plans and queues it."""
+    main = load_main(tempfile.mkdtemp(prefix="bench-"))
+    add_accounts(main, args.accounts, daily_limit=500)
+    filename = "leads.csv"
+    with open(os.path.join(main.UPLOAD_FOLDER, filename), "w", newline="") as f:
+        out = csv.writer(f)
+        out.writerow(["email", "first_name", "company"])
+        out.writerows((f"lead{i}@example.com", f"Lead{i}", f"Company {i % 1000}") for i in range(args.rows))
+
+    client = main.app.test_client()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.start_web()
+        response = client.post("/select", data={
+            "filename": filename, "campaign_name": "benchmark", "email_col": "email",
+            "subject_template": "Quick question for {{company}}",
+            "body_template": "<p>Hi {{first_name}},</p>" + "<p>Just following up on our conversation.</p>" * 20,
+        })
+        if response.status_code != 302:
+            raise RuntimeError(f"/select failed: {response.status_code} {response.data[:200]!r}")
+        with sqlite3.connect(main.DB_PATH) as conn:
+            while True:
+                status, inserted, error = conn.execute(
+                    "SELECT status, inserted, error FROM import_jobs ORDER BY id DESC LIMIT 1").fetchone()
+                if status not in ("queued", "running"):
+                    break
+                time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    if status != "done":
+        raise RuntimeError(f"import job {status}: {error}")
+    return [{"benchmark": "ingest", "rows": args.rows, "inserted": inserted,
+             "seconds": round(elapsed, 3), "per_second": round(args.rows / elapsed, 1)}]
+
+
+def bench_sync(args):
+    """Sync --rows messages into each of --accounts mailboxes through the IMAP supervisor."""
+    imap = FakeIMAPServer(make_mailbox(args.rows), latency=args.imap_latency / 1000)
+    main = load_main(tempfile.mkdtemp(prefix="bench-"))
+    main.IMAP_USE_SSL = False
+    seed_sent_emails(main, args.rows)
+    add_accounts(main, args.accounts, imap_port=imap.port)
+
+    total = args.rows * args.accounts
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.background_inbox_fetch_parallel()
+        with sqlite3.connect(main.DB_PATH) as conn:
+            while conn.execute("SELECT COUNT(*) FROM inbox_messages").fetchone()[0] < total:
+                time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    with sqlite3.connect(main.DB_PATH) as conn:
+        replied = conn.execute("SELECT COUNT(*) FROM emails WHERE replied = 1").fetchone()[0]
+    return [{"benchmark": "sync", "messages": total, "accounts": args.accounts, "replies_matched": replied,
+             "imap_latency": args.imap_latency,
+             "seconds": round(elapsed, 3), "per_second": round(total / elapsed, 1)}]
+
+
+def bench_pixel(args):
+    """Hit /pixel.gif over loopback HTTP from --concurrency threads, then wait for the opens to land."""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    main = load_main(tempfile.mkdtemp(prefix="bench-"))
+    seed_sent_emails(main, args.rows)
+    server = make_server("127.0.0.1", 0, main.app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}/pixel.gif?uid=bench-"
+    uids = random.Random(0).sample(range(args.rows), min(args.requests, args.rows))
+
+    def hit(uid):
+        with urllib.request.urlopen(base + str(uid)) as response:
+            response.read()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.start_web()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(hit, uids))
+        elapsed = time.perf_counter() - started
+        # Opens are written behind the request; time until they are all in the table
+        # (seed_sent_emails already marked every third email opened)
+        expected = sum(1 for i in range(args.rows) if i % 3 == 0) + sum(1 for uid in uids if uid % 3)
+        with sqlite3.connect(main.DB_PATH) as conn:
+            while (conn.execute("SELECT COUNT(*) FROM emails WHERE opened = 1").fetchone()[0]
+                   + main.open_tracker.stats["dropped"] < expected):
+                time.sleep(0.01)
+        written = time.perf_counter() - started
+    return [{"benchmark": "pixel", "rows": args.rows, "requests": len(uids), "concurrency": args.concurrency,
+             "seconds": round(elapsed, 3), "per_second": round(len(uids) / elapsed, 1),
+             "dropped": main.open_tracker.stats["dropped"], "written_seconds": round(written, 3)}]
+
+
+def bench_dashboard(args):
+    """Render /dashboard --repeat times against --rows sent emails."""
+    main = load_main(tempfile.mkdtemp(prefix="bench-"))
+    seed_seconds = seed_sent_emails(main, args.rows, campaigns=50)
+    client = main.app.test_client()
+    timings = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        response = client.get("/dashboard")
+        timings.append((time.perf_counter() - started) * 1000)
+        if response.status_code != 200:
+            raise RuntimeError(f"/dashboard failed: {response.status_code}")
+    timings.sort()
+    return [{"benchmark": "dashboard", "rows": args.rows, "repeat": args.repeat,
+             "median_ms": round(statistics.median(timings), 2),
+             "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 2),
+             "seed_seconds": round(seed_seconds, 1)}]
+
+
+def table_scan_seconds(path):
+    """Time a full scan of the emails table on a fresh connection (opened has no index)."""
+    with sqlite3.connect(path) as conn:
+        started = time.perf_counter()
+        conn.execute("SELECT COUNT(*) FROM emails WHERE opened = 0").fetchone()
+        return time.perf_counter() - started
+
+
+def database_size(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+
+
+def bench_storage(args):
+    """Queue one synthetic campaign with message bodies inline (schema before migration 10)
+    and in the content-addressed body store, then compare size and scan speed."""
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    main = load_main(workdir)
+    import db
+
+    bodies = [f"<p>Hi there,</p><p>Variant {n}.</p>" + "<p>Just following up on our conversation about the project.</p>" * 20
+              for n in range(10)]
+    leads = [{"email": f"lead{i}@example.com", "subject": f"Quick question {i}", "body": bodies[i % len(bodies)]}
+             for i in range(args.rows)]
+
+    inline_path = os.path.join(workdir, "inline.db")
+    inline_migrations = [migration for migration in db.MIGRATIONS if migration[0] < 10]
+    with sqlite3.connect(inline_path) as conn:
+        all_migrations, db.MIGRATIONS = db.MIGRATIONS, inline_migrations
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                db.run_migrations(conn)
+        finally:
+            db.MIGRATIONS = all_migrations
+        campaign_id = conn.execute("INSERT INTO campaigns (name) VALUES ('benchmark')").lastrowid
+        started = time.perf_counter()
+        for offset in range(0, args.rows, main.INGEST_BATCH_SIZE):
+            batch = []
+            for lead in leads[offset:offset + main.INGEST_BATCH_SIZE]:
+                uid = str(uuid.uuid4())
+                batch.append((uid, lead["email"], lead["subject"], f"{lead['body']}\n{main.tracking_pixel_tag(uid)}",
+                              datetime.utcnow(), campaign_id))
+            conn.executemany("INSERT INTO emails (uid, email, subject, message, next_send_time, campaign_id) VALUES (?, ?, ?, ?, ?, ?)",
+                             batch)
+        conn.commit()
+        inline_ingest = time.perf_counter() - started
+
+    store_path = os.path.join(workdir, main.DB_PATH)
+    with sqlite3.connect(store_path) as conn:
+        campaign_id = conn.execute("INSERT INTO campaigns (name, track_opens) VALUES ('benchmark', 1)").lastrowid
+        with contextlib.redirect_stdout(io.StringIO()):
+            planner = main.SendPlanner(conn)
+            _, store_ingest = main.ingest_campaign_rows(conn, iter(leads), campaign_id, "email", "subject", "body", planner)
+        conn.commit()
+
+    results = []
+    for layout, path, ingest_seconds in (("inline", inline_path, inline_ingest),
+                                         ("content-addressed", store_path, store_ingest)):
+        results.append({"benchmark": "storage", "layout": layout, "rows": args.rows,
+                        "megabytes": round(database_size(path) / 2 ** 20, 1),
+                        "ingest_seconds": round(ingest_seconds, 2),
+                        "scan_seconds": round(table_scan_seconds(path), 3)})
+    return results
+
+
+BENCHMARKS = {
+    "send": bench_send,
+    "storage": bench_storage,
+    "ingest": bench_ingest,
+    "sync": bench_sync,
+    "pixel": bench_pixel,
+    "dashboard": bench_dashboard,
+}
+
+# --rows when not given; dashboard is measured against a 1M-email table
+DEFAULT_ROWS = {
+    "send": 5000,
+    "storage": 5000,
+    "ingest": 100000,
+    "sync": 20000,
+    "pixel": 100000,
+    "dashboard": 1000000,
+}
+
+
+def run_all(args):
+    """Run every benchmark in its own process (each imports main.py against its own scratch database)."""
+    results = []
+    for name in BENCHMARKS:
+        command = [sys.executable, os.path.abspath(__file__), name, "--json",
+                   "--accounts", str(args.accounts), "--smtp-latency", str(args.smtp_latency),
+                   "--imap-latency", str(args.imap_latency), "--requests", str(args.requests),
+                   "--concurrency", str(args.concurrency), "--repeat", str(args.repeat)]
+        if args.rows is not None:
+            command += ["--rows", str(args.rows)]
+        print(f"[BENCHMARK] {name}...", file=sys.stderr)
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results.extend(json.loads(line) for line in output.splitlines() if line.startswith("{"))
+    return results
+
+
+def environment():
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stdout=subprocess.PIPE,
+                                  stderr=subprocess.DEVNULL, text=True).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {"revision": revision, "timestamp": datetime.utcnow().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(), "cpus": os.cpu_count()}
+
+
+def result_key(result):
+    # Non-numeric fields (benchmark, mode, layout) identify a result across runs
+    return tuple(sorted((key, value) for key, value in result.items() if isinstance(value, str)))
+
+
+def compare(results, baseline_path, tolerance):
+    """Print how each result moved against a saved --output file; returns the number of regressions.
+
+    per_second is better higher, *_ms is better lower; anything worse by more than
+    `tolerance` (a fraction) counts as a regression.
+    """
+    with open(baseline_path) as f:
+        baseline = {result_key(result): result for result in json.load(f)["results"]}
+    regressions = 0
+    for result in results:
+        before = baseline.get(result_key(result))
+        if before is None:
+            continue
+        for key, value in result.items():
+            if not (key == "per_second" or key.endswith("_ms")) or not before.get(key):
+                continue
+            change = value / before[key] - 1
+            worse = change < -tolerance if key == "per_second" else change > tolerance
+            regressions += worse
+            label = " ".join(value for _, value in result_key(result))
+            print(f"{'REGRESSION' if worse else 'ok':10} {label} {key}: {before[key]} -> {value} ({change:+.1%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput benchmarks against local fake servers")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS) + ["all"])
+    parser.add_argument("--rows", type=int, default=None, help="rows (or messages, for sync); see DEFAULT_ROWS")
+    parser.add_argument("--accounts", type=int, default=8)
+    parser.add_argument("--smtp-latency", type=float, default=0.0, help="milliseconds per DATA reply")
+    parser.add_argument("--imap-latency", type=float, default=0.0, help="milliseconds per SELECT/UID command")
+    parser.add_argument("--requests", type=int, default=20000, help="pixel requests")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent pixel clients")
+    parser.add_argument("--repeat", type=int, default=20, help="dashboard renders")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    parser.add_argument("--output", help="write results and environment to this JSON file")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare against an earlier --output file")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown before --compare fails")
+    args = parser.parse_args()
+
+    if args.benchmark == "all":
+        results = run_all(args)
+    else:
+        if args.rows is None:
+            args.rows = DEFAULT_ROWS[args.benchmark]
+        results = BENCHMARKS[args.benchmark](args)
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(", ".join(f"{key}={value}" for key, value in result.items()))
+    sys.stdout.flush()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2)
+    regressions = compare(results, args.compare, args.tolerance) if args.compare else 0
+    sys.stdout.flush()
+    os._exit(1 if regressions else 0)  # don't wait on main.py's background threads
+
+
+if __name__ == '__main__':
+    main()
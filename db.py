@@ -0,0 +1,663 @@
+# db.py - connections, writer queue and schema migrations for the cold email tool database
+
+import hashlib
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
+DB_PATH = 'email_tool.db'
+BUSY_TIMEOUT_SECONDS = 10  # how long a connection waits for a lock before "database is locked"
+CACHE_SIZE_KB = 16384  # page cache per connection
+MMAP_SIZE = 256 * 1024 * 1024  # bytes of the database file read through mmap
+WRITE_BATCH_MAX = 500  # most queued writes combined into one commit
+WRITE_BATCH_DELAY = 0.0  # seconds the writer waits for more writes to join a commit (0 = take what is queued)
+POOL_SIZE = 8  # idle connections kept for short-lived threads (one per web request)
+
+
+def connect(db_path=DB_PATH, check_same_thread=True):
+    """Open a connection in WAL mode with the pragmas every connection should use.
+
+    WAL lets readers (dashboard, pixel lookups) run while a write is in progress,
+    and synchronous=NORMAL only fsyncs at checkpoints instead of on every commit.
+    """
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_SECONDS, check_same_thread=check_same_thread)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+_local = threading.local()
+
+
+def get_connection(db_path=DB_PATH):
+    """This thread's connection: the one leased from the pool (see ConnectionPool.lease),
+    else its own, opened on first use and reused afterwards.
+
+    Use it as `with get_connection() as conn:` like a plain sqlite3 connection: the
+    block commits on success and rolls back on error, but the connection stays open.
+    """
+    leased = getattr(_local, 'leased', None)
+    if leased is not None and leased[0] == db_path:
+        return leased[1]
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = connections[db_path] = connect(db_path)
+    return conn
+
+
+class ConnectionPool:
+    """Connections shared by short-lived threads, such as the web server's thread per request.
+
+    Such a thread would otherwise open (and run the pragmas on) a connection of its
+    own every time. Instead it lease()s a pooled connection, which get_connection()
+    returns until release() puts it back. Only one thread uses a connection at a time.
+    """
+
+    def __init__(self, db_path=DB_PATH, size=POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self.stats = {'opened': 0, 'leases': 0}
+
+    def checkout(self):
+        with self._lock:
+            self.stats['leases'] += 1
+            if self._idle:
+                return self._idle.pop()
+            self.stats['opened'] += 1
+        return connect(self.db_path, check_same_thread=False)
+
+    def checkin(self, conn):
+        if conn.in_transaction:
+            conn.rollback()  # a request that failed mid-write mustn't leave its lock behind
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def lease(self):
+        """Bind a pooled connection to the calling thread until release()."""
+        if getattr(_local, 'leased', None) is None:
+            _local.leased = (self.db_path, self.checkout())
+
+    def release(self):
+        leased = getattr(_local, 'leased', None)
+        if leased is not None:
+            _local.leased = None
+            self.checkin(leased[1])
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class WriteQueue:
+    """A single writer thread that applies small queued writes in combined transactions.
+
+    Each write is a function called as fn(conn, *args) on the writer's connection,
+    inside its own savepoint so one failing write doesn't undo the others. Writes that
+    arrive together share one commit (and one fsync); each submit() returns a Future
+    that resolves once its write has been committed.
+    """
+
+    def __init__(self, db_path=DB_PATH, max_batch=WRITE_BATCH_MAX, max_delay=WRITE_BATCH_DELAY):
+        self.db_path = db_path
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {'writes': 0, 'commits': 0, 'failed': 0}
+
+    def submit(self, fn, *args):
+        self._start()
+        future = Future()
+        self._queue.put((future, fn, args))
+        return future
+
+    def execute(self, sql, params=()):
+        return self.submit(lambda conn: conn.execute(sql, params).rowcount)
+
+    def flush(self):
+        """Wait until everything submitted so far has been committed."""
+        self.submit(lambda conn: None).result()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        conn = connect(self.db_path)
+        conn.isolation_level = None  # transactions are managed explicitly below
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._apply(conn, batch)
+
+    def _apply(self, conn, batch):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for future, fn, args in batch:
+                conn.execute("SAVEPOINT write")
+                try:
+                    results.append((future, fn(conn, *args), None))
+                    conn.execute("RELEASE write")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    conn.execute("RELEASE write")
+                    results.append((future, None, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            results = [(future, None, e) for future, fn, args in batch]
+        self.stats['writes'] += len(batch)
+        self.stats['commits'] += 1
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                self.stats['failed'] += 1
+                future.set_exception(error)
+
+
+writer = WriteQueue()
+pool = ConnectionPool()
+
+
+def _column_names(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _add_column(conn, table, column, decl):
+    if column not in _column_names(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        return True
+    return False
+
+
+def _create_base_tables(conn):
+    # Create campaigns table
+    conn.execute('''CREATE TABLE IF NOT EXISTS campaigns (
+        id INTEGER PRIMARY KEY,
+        name TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    # Create emails table (columns added later are handled by _add_queue_columns)
+    conn.execute('''CREATE TABLE IF NOT EXISTS emails (
+        id INTEGER PRIMARY KEY,
+        uid TEXT,
+        email TEXT,
+        subject TEXT,
+        message TEXT,
+        sent_at TIMESTAMP,
+        opened INTEGER DEFAULT 0,
+        opened_at TIMESTAMP,
+        replied INTEGER DEFAULT 0,
+        replied_at TIMESTAMP,
+        account_email TEXT,
+        next_send_time TIMESTAMP,
+        is_sending INTEGER DEFAULT 0,
+        message_id TEXT
+    )''')
+
+    # Create accounts table
+    conn.execute('''CREATE TABLE IF NOT EXISTS accounts (
+        id INTEGER PRIMARY KEY,
+        email TEXT UNIQUE,
+        smtp_host TEXT,
+        smtp_port INTEGER,
+        smtp_user TEXT,
+        smtp_pass TEXT,
+        imap_host TEXT,
+        imap_port INTEGER,
+        imap_user TEXT,
+        imap_pass TEXT,
+        daily_limit INTEGER,
+        last_sent DATE,
+        sent_today INTEGER DEFAULT 0
+    )''')
+
+
+def _add_queue_columns(conn):
+    # Databases created before campaigns existed: move their emails into a default campaign
+    if _add_column(conn, "emails", "campaign_id", "INTEGER REFERENCES campaigns(id)"):
+        if conn.execute("SELECT 1 FROM emails LIMIT 1").fetchone():
+            cursor = conn.execute("INSERT INTO campaigns (name) VALUES (?)", ("Default Campaign",))
+            conn.execute("UPDATE emails SET campaign_id = ? WHERE campaign_id IS NULL", (cursor.lastrowid,))
+
+    # Send lease columns used by claim_ready_emails
+    _add_column(conn, "emails", "lease_owner", "TEXT")
+    _add_column(conn, "emails", "lease_expires", "TIMESTAMP")
+
+
+def _add_hot_path_indexes(conn):
+    # tracking_pixel looks emails up by uid
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_emails_uid ON emails(uid)")
+    # check_reply_tracking looks emails up by the Message-ID we sent
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_emails_message_id ON emails(message_id)")
+    # The send queue: only unsent, unclaimed rows, ordered by due time
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_unsent ON emails(next_send_time)
+                    WHERE sent_at IS NULL AND is_sending = 0''')
+    # The lease reaper: only rows currently claimed by a worker
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_leased ON emails(lease_expires)
+                    WHERE is_sending = 1 AND sent_at IS NULL''')
+    # Per-campaign stats on the dashboard
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_emails_campaign ON emails(campaign_id)")
+
+
+def _create_campaign_stats(conn):
+    # Per-campaign counters kept up to date as emails change state, so the dashboard
+    # never has to aggregate the emails table
+    conn.execute('''CREATE TABLE IF NOT EXISTS campaign_stats (
+        campaign_id INTEGER PRIMARY KEY REFERENCES campaigns(id),
+        total INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        opened INTEGER NOT NULL DEFAULT 0,
+        replied INTEGER NOT NULL DEFAULT 0
+    )''')
+    rebuild_campaign_stats(conn)
+
+
+def rebuild_campaign_stats(conn):
+    """Recompute campaign_stats from the emails table (reconciles any drift)."""
+    conn.execute("DELETE FROM campaign_stats")
+    conn.execute('''INSERT INTO campaign_stats (campaign_id, total, sent, opened, replied)
+                    SELECT c.id,
+                           COUNT(e.id),
+                           COALESCE(SUM(CASE WHEN e.sent_at IS NOT NULL THEN 1 ELSE 0 END), 0),
+                           COALESCE(SUM(e.opened), 0),
+                           COALESCE(SUM(e.replied), 0)
+                    FROM campaigns c
+                    LEFT JOIN emails e ON c.id = e.campaign_id
+                    GROUP BY c.id''')
+
+
+def bump_campaign_stat(conn, campaign_id, column, amount=1):
+    """Add amount to one campaign_stats counter; call inside the transaction that changed the email."""
+    if campaign_id is None:
+        return
+    conn.execute("INSERT OR IGNORE INTO campaign_stats (campaign_id) VALUES (?)", (campaign_id,))
+    conn.execute(f"UPDATE campaign_stats SET {column} = {column} + ? WHERE campaign_id = ?",
+                 (amount, campaign_id))
+
+
+def _create_imap_sync_state(conn):
+    # Per-mailbox high-water mark for incremental IMAP sync
+    conn.execute('''CREATE TABLE IF NOT EXISTS imap_sync_state (
+        account_key TEXT PRIMARY KEY,
+        uidvalidity INTEGER,
+        last_uid INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP
+    )''')
+
+
+def _create_inbox_messages(conn):
+    # Synced inbound mail, keyed by mailbox and Message-ID
+    conn.execute('''CREATE TABLE IF NOT EXISTS inbox_messages (
+        id INTEGER PRIMARY KEY,
+        account_key TEXT NOT NULL,
+        message_id TEXT NOT NULL,
+        uid INTEGER,
+        from_addr TEXT,
+        subject TEXT,
+        body TEXT,
+        refs TEXT,
+        date_header TEXT,
+        received_at TIMESTAMP,
+        replied_at TIMESTAMP,
+        UNIQUE (account_key, message_id)
+    )''')
+    # /inbox pages newest-first, optionally for one mailbox
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_inbox_account_received ON inbox_messages(account_key, received_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_inbox_received ON inbox_messages(received_at)")
+
+
+def _add_send_plan(conn):
+    # The account each queued email is planned to go out from, and each campaign's projected finish
+    _add_column(conn, "emails", "planned_account", "TEXT")
+    _add_column(conn, "campaigns", "projected_completion", "TIMESTAMP")
+    # Per-account claims and the planner's per-account queue load
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_emails_unsent_planned ON emails(planned_account, next_send_time)
+                    WHERE sent_at IS NULL AND is_sending = 0''')
+
+
+def _add_rendered_message(conn):
+    # Ready-to-send message bytes (minus From and Message-ID), filled ahead of next_send_time
+    _add_column(conn, "emails", "rendered", "BLOB")
+
+
+def _add_campaign_templates(conn):
+    # Per-campaign {{column}} templates; templated emails store only the referenced values in vars
+    _add_column(conn, "campaigns", "subject_template", "TEXT")
+    _add_column(conn, "campaigns", "body_template", "TEXT")
+    _add_column(conn, "campaigns", "track_opens", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, "emails", "vars", "TEXT")
+
+
+def body_hash(body):
+    """Content address of a message body in email_bodies."""
+    return hashlib.blake2b(body.encode('utf-8'), digest_size=16).digest()
+
+
+def store_bodies(conn, bodies):
+    """Store (hash, body) pairs zlib-compressed, skipping bodies that are already stored."""
+    conn.executemany("INSERT OR IGNORE INTO email_bodies (hash, body) VALUES (?, ?)",
+                     [(digest, zlib.compress(body.encode('utf-8'))) for digest, body in bodies])
+
+
+def load_body(conn, digest):
+    row = conn.execute("SELECT body FROM email_bodies WHERE hash = ?", (digest,)).fetchone()
+    return zlib.decompress(row[0]).decode('utf-8') if row else None
+
+
+def _move_bodies_to_store(conn):
+    # Message bodies live once per distinct body, compressed, keyed by hash; emails keep the hash
+    conn.execute('''CREATE TABLE IF NOT EXISTS email_bodies (
+        hash BLOB PRIMARY KEY,
+        body BLOB NOT NULL
+    ) WITHOUT ROWID''')
+    _add_column(conn, "emails", "body_hash", "BLOB")
+
+    # Existing emails have their tracking pixel baked into the message, which would make
+    # every body unique; strip it and flag the campaign so the pixel is added at render time
+    tracked = set()
+    last_id = 0
+    while True:
+        rows = conn.execute('''SELECT id, uid, campaign_id, message FROM emails
+                               WHERE id > ? AND message IS NOT NULL ORDER BY id LIMIT 5000''', (last_id,)).fetchall()
+        if not rows:
+            break
+        bodies = {}
+        updates = []
+        for id_, uid, campaign_id, message in rows:
+            pixel = f'\n<img src=".../pixel.gif?uid={uid}" width="1" height="1">'
+            if message.endswith(pixel):
+                message = message[:-len(pixel)]
+                tracked.add(campaign_id)
+            digest = body_hash(message)
+            bodies[digest] = message
+            updates.append((digest, id_))
+        store_bodies(conn, bodies.items())
+        conn.executemany("UPDATE emails SET body_hash = ?, message = NULL WHERE id = ?", updates)
+        last_id = rows[-1][0]
+    conn.executemany("UPDATE campaigns SET track_opens = 1 WHERE id = ?", [(id_,) for id_ in tracked])
+
+
+def _create_import_jobs(conn):
+    # Background CSV imports; rows_read is also the resume offset, committed with each batch
+    conn.execute('''CREATE TABLE IF NOT EXISTS import_jobs (
+        id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        params TEXT,
+        campaign_id INTEGER REFERENCES campaigns(id),
+        status TEXT NOT NULL DEFAULT 'queued',
+        rows_read INTEGER NOT NULL DEFAULT 0,
+        inserted INTEGER NOT NULL DEFAULT 0,
+        rejected INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP
+    )''')
+    # Rows an import skipped, and why
+    conn.execute('''CREATE TABLE IF NOT EXISTS import_errors (
+        id INTEGER PRIMARY KEY,
+        job_id INTEGER NOT NULL REFERENCES import_jobs(id),
+        row_number INTEGER NOT NULL,
+        error TEXT
+    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_import_errors_job ON import_errors(job_id, row_number)")
+
+
+def normalize_address(address):
+    """Canonical form of an email address for dedup and suppression.
+
+    Lowercased and trimmed; for Gmail, dots and +tags in the local part are dropped
+    since they all reach the same mailbox.
+    """
+    address = address.strip().strip('<>').lower()
+    local, _, domain = address.rpartition('@')
+    if domain in ('gmail.com', 'googlemail.com') and local:
+        local = local.split('+', 1)[0].replace('.', '')
+        return f"{local}@gmail.com"
+    return address
+
+
+def address_hash(address):
+    """64-bit signed hash of a normalized address, stored as an INTEGER key."""
+    digest = hashlib.blake2b(normalize_address(address).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def _create_suppressions(conn):
+    # Addresses that must never be queued or sent to again, by hash only
+    conn.execute('''CREATE TABLE IF NOT EXISTS suppressions (
+        addr_hash INTEGER PRIMARY KEY,
+        reason TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    # Hashed recipient for dedup, and when a queued email was dropped by suppression
+    _add_column(conn, "emails", "addr_hash", "INTEGER")
+    _add_column(conn, "emails", "suppressed_at", "TIMESTAMP")
+    last_id = 0
+    while True:
+        rows = conn.execute("SELECT id, email FROM emails WHERE id > ? ORDER BY id LIMIT 5000", (last_id,)).fetchall()
+        if not rows:
+            break
+        conn.executemany("UPDATE emails SET addr_hash = ? WHERE id = ?",
+                         [(address_hash(email or ''), id_) for id_, email in rows])
+        last_id = rows[-1][0]
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_emails_addr_hash ON emails(addr_hash)")
+
+
+def _create_signals(conn):
+    # Change counters other processes poll, e.g. the sender noticing a campaign queued by the web process
+    conn.execute('''CREATE TABLE IF NOT EXISTS signals (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )''')
+
+
+def bump_signal(conn, name):
+    """Tell workers in other processes that `name` changed; call inside the transaction that changed it."""
+    conn.execute('''INSERT INTO signals (name, value) VALUES (?, 1)
+                    ON CONFLICT(name) DO UPDATE SET value = value + 1''', (name,))
+
+
+def read_signals(conn):
+    return dict(conn.execute("SELECT name, value FROM signals"))
+
+
+def _add_protocol_debug(conn):
+    # Per-account opt-in for SMTP/IMAP protocol traces (they used to be on for every account)
+    _add_column(conn, "accounts", "protocol_debug", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _create_outbound_replies(conn):
+    # Priority lane of the outbound queue: /reply only queues, the sender process delivers
+    conn.execute('''CREATE TABLE IF NOT EXISTS outbound_replies (
+        id INTEGER PRIMARY KEY,
+        account_email TEXT NOT NULL,
+        to_addr TEXT NOT NULL,
+        message BLOB NOT NULL,
+        message_id TEXT NOT NULL,
+        inbox_account TEXT,
+        in_reply_to TEXT,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        next_attempt_at TIMESTAMP,
+        lease_owner TEXT,
+        lease_expires TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        sent_at TIMESTAMP
+    )''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_outbound_replies_queued ON outbound_replies(account_email, next_attempt_at)
+                    WHERE status = 'queued' ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbound_replies_thread ON outbound_replies(in_reply_to)")
+
+
+def _add_render_failures(conn):
+    # Emails that can't be rendered (e.g. a header-breaking CSV value) leave the queue with the error
+    _add_column(conn, "emails", "failed_at", "TIMESTAMP")
+    _add_column(conn, "emails", "error", "TEXT")
+
+
+def _add_import_leases(conn):
+    # The process running an import holds a lease, renewed with each batch, so another
+    # process only resumes the job once that lease has expired
+    _add_column(conn, "import_jobs", "lease_owner", "TEXT")
+    _add_column(conn, "import_jobs", "lease_expires", "TIMESTAMP")
+
+
+def _add_reply_lease_index(conn):
+    # The lease reaper looks for replies stuck in 'sending' every minute
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_outbound_replies_leased ON outbound_replies(lease_expires)
+                    WHERE status = 'sending' ''')
+
+
+# Ordered list of (version, description, function). Append new migrations to the end;
+# never edit or reorder one that has already shipped.
+MIGRATIONS = [
+    (1, "base tables", _create_base_tables),
+    (2, "campaign and lease columns on emails", _add_queue_columns),
+    (3, "indexes for hot lookups", _add_hot_path_indexes),
+    (4, "campaign_stats counters", _create_campaign_stats),
+    (5, "imap sync high-water marks", _create_imap_sync_state),
+    (6, "persistent inbox store", _create_inbox_messages),
+    (7, "planned sender account and projected completion", _add_send_plan),
+    (8, "pre-rendered message bytes", _add_rendered_message),
+    (9, "campaign personalization templates", _add_campaign_templates),
+    (10, "content-addressed compressed message bodies", _move_bodies_to_store),
+    (11, "background import jobs", _create_import_jobs),
+    (12, "suppression list and recipient dedup", _create_suppressions),
+    (13, "cross-process signals", _create_signals),
+    (14, "per-account protocol debugging", _add_protocol_debug),
+    (15, "outbound reply queue", _create_outbound_replies),
+    (16, "failed emails", _add_render_failures),
+    (17, "import job leases", _add_import_leases),
+    (18, "index on leased replies", _add_reply_lease_index),
+]
+
+
+def schema_version(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def run_migrations(conn):
+    """Apply every migration newer than the database's schema version, each in its own transaction.
+
+    Every role runs this at startup, so several processes may race here: the version
+    is re-read once the write lock is held, and migrations another process applied
+    meanwhile are skipped.
+    """
+    current = schema_version(conn)
+    for version, name, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+        if version <= current:
+            conn.rollback()
+            continue
+        print(f"[MIGRATE] Applying migration {version}: {name}")
+        try:
+            migrate(conn)
+            conn.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (version, name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return schema_version(conn)
+
+
+def unindexed_hot_queries(conn, queries):
+    """Return {query name: plan} for every query whose plan scans a whole table.
+
+    `queries` maps names to the SQL the app actually runs (main.HOT_QUERIES); each
+    {placeholders} list is planned with two values and every parameter bound as NULL.
+    """
+    failures = {}
+    for name, sql in queries.items():
+        sql = sql.replace("{placeholders}", "?, ?")
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", [None] * sql.count("?"))]
+        if any(step.startswith("SCAN ") and "INDEX" not in step for step in plan):
+            failures[name] = plan
+    return failures
+
+
+def check_query_plans(queries):
+    """Migrate a scratch database and verify every hot query uses an index."""
+    with sqlite3.connect(":memory:") as conn:
+        print(f"[MIGRATE] Schema version {run_migrations(conn)}")
+        failures = unindexed_hot_queries(conn, queries)
+        for name, plan in failures.items():
+            print(f"[QUERY PLAN] {name} does a table scan: {plan}")
+        assert not failures, "hot queries without an index"
+        print(f"[QUERY PLAN] All {len(queries)} hot queries use an index")
+
+
+def rebuild_stats(db_path=DB_PATH):
+    with sqlite3.connect(db_path) as conn:
+        run_migrations(conn)
+        rebuild_campaign_stats(conn)
+        conn.commit()
+        campaigns = conn.execute("SELECT COUNT(*) FROM campaign_stats").fetchone()[0]
+    print(f"[STATS] Rebuilt campaign_stats for {campaigns} campaigns")
+
+
+def vacuum(db_path=DB_PATH):
+    # Migrations that move data out of emails only free pages; VACUUM gives them back to the OS
+    with sqlite3.connect(db_path) as conn:
+        run_migrations(conn)
+        before = conn.execute("PRAGMA page_count").fetchone()[0]
+        conn.execute("VACUUM")
+        after = conn.execute("PRAGMA page_count").fetchone()[0]
+    print(f"[VACUUM] {before} -> {after} pages")
+
+
+if __name__ == '__main__':
+    # Hand-run maintenance commands:
+    #   python db.py                      check that hot queries use an index
+    #   python db.py rebuild-stats [db]   recompute campaign_stats from emails
+    #   python db.py vacuum [db]          reclaim space after a migration moved data out
+    command = sys.argv[1] if len(sys.argv) > 1 else 'check-indexes'
+    if command == 'rebuild-stats':
+        rebuild_stats(*sys.argv[2:3])
+    elif command == 'vacuum':
+        vacuum(*sys.argv[2:3])
+    elif command == 'check-indexes':
+        from main import HOT_QUERIES  # the app's own SQL; main imports this module, so only here
+        check_query_plans(HOT_QUERIES)
+    else:
+        sys.exit(f"Unknown command: {command}")
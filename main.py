@@ -2,122 +2,129 @@
 
 import os
 import csv
-import sqlite3
-import imaplib
 import smtplib
 import base64
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta, date, timezone
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from flask import Flask, request, redirect, render_template, jsonify, send_file
+from flask import Flask, Response, request, redirect, render_template, jsonify, url_for
 from apscheduler.schedulers.background import BackgroundScheduler
 from werkzeug.utils import secure_filename
 import uuid
 import asyncio
 import time
 import atexit
-import select
+import ssl
+import socket
 import threading
+import heapq
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import email.utils
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser
 import random
 import re
+import json
+import html
+import itertools
+import hashlib
+import argparse
+import traceback
+from metrics import registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from db import DB_PATH, connect, get_connection, pool, writer, run_migrations, bump_signal, read_signals, bump_campaign_stat, body_hash, store_bodies, load_body, address_hash
 
 UPLOAD_FOLDER = 'uploads'
-DB_PATH = 'email_tool.db'
 TRACKING_PIXEL_PATH = 'pixel.png'
 SEND_INTERVAL_MINUTES = 10  # base interval for each email
 MIN_WAIT_MINUTES = 5  # minimum wait time
 MAX_WAIT_MINUTES = 15  # maximum wait time
-
-# Global variable for storing per-account messages
-per_account_messages = {}
+INGEST_BATCH_SIZE = 5000  # rows per executemany batch when queueing a campaign
+BODY_CACHE_SIZE = 256  # decompressed message bodies kept in memory for rendering
+INGEST_BODY_MEMORY = 100000  # body hashes remembered while queueing a campaign
+DEDUP_ACROSS_CAMPAIGNS = True  # skip leads already queued by any campaign, not just this one
+HASH_LOOKUP_CHUNK = 900  # address hashes per IN (...) lookup
+SMTP_POOL_SIZE = 1  # authenticated SMTP sessions kept open per account
+SMTP_NOOP_AFTER_SECONDS = 60  # NOOP-probe a pooled session idle for longer than this
+SMTP_MAX_SESSION_AGE = 900  # recycle pooled sessions older than this (seconds)
+SMTP_MAX_MESSAGES_PER_SESSION = 100  # recycle a session after this many messages
+OPEN_QUEUE_MAX = 50000  # pending pixel hits held in memory before new ones are dropped
+OPEN_FLUSH_BATCH = 1000  # max open events written per transaction
+OPEN_FLUSH_INTERVAL = 1.0  # seconds to wait for a batch to fill before flushing
+OPEN_DEDUP_SIZE = 100000  # recently seen uids remembered to skip repeat opens
+IMAP_FETCH_BATCH = 200  # messages fetched per UID FETCH command during inbox sync
+IMAP_BODY_PREFIX_BYTES = 4096  # only this much of each message body is downloaded
+IMAP_FETCH_ITEMS = ('(UID BODY.PEEK[HEADER.FIELDS (FROM SUBJECT MESSAGE-ID REFERENCES IN-REPLY-TO DATE CONTENT-TYPE)] '
+                    f'BODY.PEEK[TEXT]<0.{IMAP_BODY_PREFIX_BYTES}>)')
+IMAP_USE_SSL = True  # connect to IMAP servers over implicit TLS
+IMAP_TIMEOUT = 60  # seconds to wait for an IMAP response outside of IDLE
+IMAP_LINE_LIMIT = 16 * 1024 * 1024  # longest response line read; a big mailbox's UID SEARCH is one line
+IMAP_IDLE_SECONDS = 29 * 60  # re-arm IDLE before servers drop it at 30 minutes
+IMAP_RETRY_INITIAL = 10  # first reconnect delay after an IMAP failure (seconds)
+IMAP_RETRY_MAX = 3600  # reconnect backoff cap (seconds)
+IMAP_PARSE_WORKERS = 4  # threads that parse fetched messages and track replies
+IMAP_ACCOUNT_REFRESH_SECONDS = 300  # how often to look for added/removed accounts
+INBOX_PAGE_SIZE = 50  # messages per /inbox page
+INBOX_CACHE_SIZE = 2000  # recently synced or viewed messages kept in memory
+REPLY_LOOKUP_CHUNK = 500  # Message-IDs per IN (...) query when matching replies
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-scheduler = BackgroundScheduler()
-scheduler.start()
+scheduler = BackgroundScheduler()  # started by the sender and web entry points
+
+# Flask runs each request on a new thread; lend it a pooled connection for the
+# request instead of letting get_connection() open a fresh one every time
+@app.before_request
+def lease_db_connection():
+    pool.lease()
+
+@app.teardown_request
+def release_db_connection(exc):
+    pool.release()
+
+atexit.register(pool.close_all)
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Database setup
-with sqlite3.connect(DB_PATH) as conn:
-    # Create campaigns table
-    conn.execute('''CREATE TABLE IF NOT EXISTS campaigns (
-        id INTEGER PRIMARY KEY,
-        name TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
-    
-    # Create emails table with campaign_id
-    conn.execute('''CREATE TABLE IF NOT EXISTS emails (
-        id INTEGER PRIMARY KEY,
-        uid TEXT,
-        email TEXT,
-        subject TEXT,
-        message TEXT,
-        sent_at TIMESTAMP,
-        opened INTEGER DEFAULT 0,
-        opened_at TIMESTAMP,
-        replied INTEGER DEFAULT 0,
-        replied_at TIMESTAMP,
-        account_email TEXT,
-        next_send_time TIMESTAMP,
-        is_sending INTEGER DEFAULT 0,
-        campaign_id INTEGER,
-        message_id TEXT,
-        FOREIGN KEY (campaign_id) REFERENCES campaigns(id)
-    )''')
-    
+# Serve the tracking pixel from memory instead of re-reading it on every hit
+with open(TRACKING_PIXEL_PATH, 'rb') as f:
+    PIXEL_BYTES = f.read()
 
-    # Create accounts table
-    conn.execute('''CREATE TABLE IF NOT EXISTS accounts (
-        id INTEGER PRIMARY KEY,
-        email TEXT UNIQUE,
-        smtp_host TEXT,
-        smtp_port INTEGER,
-        smtp_user TEXT,
-        smtp_pass TEXT,
-        imap_host TEXT,
-        imap_port INTEGER,
-        imap_user TEXT,
-        imap_pass TEXT,
-        daily_limit INTEGER,
-        last_sent DATE,
-        sent_today INTEGER DEFAULT 0
-    )''')
-    
-    # Add campaign_id column if it doesn't exist
-    try:
-        conn.execute("ALTER TABLE emails ADD COLUMN campaign_id INTEGER")
-        
-        # Create a default campaign for existing emails
-        cursor = conn.execute("INSERT INTO campaigns (name) VALUES (?)", 
-                            ("Default Campaign",))
-        default_campaign_id = cursor.lastrowid
-        
-        # Update existing emails to belong to the default campaign
-        conn.execute("UPDATE emails SET campaign_id = ? WHERE campaign_id IS NULL", 
-                    (default_campaign_id,))
-    except sqlite3.OperationalError:
-        # Column already exists, ignore error
-        pass
-    
-    conn.commit()
+def init_db():
+    """Bring the schema up to date (see db.MIGRATIONS); every entry point calls this first."""
+    with connect() as conn:
+        run_migrations(conn)
+
+# This process's slice of the accounts table, as (index, count); see set_shard
+SHARD = (0, 1)
+
+def set_shard(index, count):
+    global SHARD
+    if not 0 <= index < count:
+        raise ValueError(f"shard {index} is not in 0..{count - 1}")
+    SHARD = (index, count)
+
+def owns_account(email_address):
+    """Whether this process's shard sends and syncs for the account.
+
+    Accounts are spread over shards by a stable hash of their address, so every
+    process agrees on the split without coordinating.
+    """
+    index, count = SHARD
+    if count == 1:
+        return True
+    digest = hashlib.blake2b((email_address or '').lower().encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count == index
 
 @app.route('/', methods=['GET', 'POST'])
 def upload():
     if request.method == 'POST':
-        print("[DEBUG] Request files:", request.files)
-        print("[DEBUG] Request form:", request.form)
         if 'file' not in request.files:
-            print("[DEBUG] No file in request.files")
             return "No file uploaded", 400
         file = request.files['file']
         if file.filename == '':
-            print("[DEBUG] Empty filename")
             return "No file uploaded", 400
-        print("[DEBUG] File:", file)
-        print("[DEBUG] Filename:", file.filename)
         
         # Add timestamp to filename to prevent duplicates
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -132,56 +139,531 @@ def upload():
         return render_template('select.html', cols=headers, filename=filename)
     return render_template('upload.html')
 
+class SendPlanner:
+    """Allocates newly queued emails to concrete (account, send time) slots.
+
+    Each account gets slots SEND_INTERVAL_MINUTES apart, starting after the last email
+    already queued for it, and no more per UTC day than its daily_limit minus what it
+    has already sent or has queued for that day. Emails still queued from earlier
+    days count against today (and then the following days). Slots from all accounts
+    are handed out in time order, spilling over into following days as capacity runs out.
+    """
+
+    def __init__(self, conn, interval_minutes=SEND_INTERVAL_MINUTES, start=None):
+        self.interval = timedelta(minutes=interval_minutes)
+        self.start = start or datetime.utcnow()
+        self.last_slot = None
+        self.used = {}  # (account email, date) -> emails sent or queued that day
+        self._heap = []  # (next free slot, account email)
+        self.daily_limit = {}
+
+        today = self.start.date()
+        accounts = conn.execute("SELECT email, daily_limit, sent_today, last_sent FROM accounts").fetchall()
+        for account_email, daily_limit, sent_today, last_sent in accounts:
+            if not daily_limit or daily_limit <= 0:
+                continue
+            self.daily_limit[account_email] = daily_limit
+            if last_sent == str(today):
+                self.used[(account_email, today)] = sent_today or 0
+
+            # Existing queue load for this account, per day, and where its queue ends
+            cursor_time = self.start
+            overdue = 0
+            for day, count, last in conn.execute('''SELECT substr(next_send_time, 1, 10), COUNT(*), MAX(next_send_time)
+                                                    FROM emails
+                                                    WHERE sent_at IS NULL AND is_sending = 0
+                                                    AND planned_account = ? AND next_send_time <= ?
+                                                    GROUP BY 1''', (account_email, datetime.max)):
+                day = date.fromisoformat(day)
+                if day < today:
+                    overdue += count
+                    continue
+                self.used[(account_email, day)] = self.used.get((account_email, day), 0) + count
+                cursor_time = max(cursor_time, datetime.fromisoformat(last) + self.interval)
+
+            # Emails from earlier days still go out first, as capacity allows: they use up
+            # today's quota, then the following days', and new slots come after them
+            day, backlog_end = today, self.start
+            while overdue:
+                take = min(overdue, max(daily_limit - self.used.get((account_email, day), 0), 0))
+                self.used[(account_email, day)] = self.used.get((account_email, day), 0) + take
+                overdue -= take
+                backlog_end = max(backlog_end, datetime.combine(day, datetime.min.time())) + take * self.interval
+                day += timedelta(days=1)
+            heapq.heappush(self._heap, (max(cursor_time, backlog_end), account_email))
+
+    def next_slot(self):
+        """Return (account email, send time) for the next email; account is None if there are no accounts."""
+        if not self._heap:
+            # Nothing to plan against: fall back to plain interval spacing
+            slot = (self.last_slot + self.interval) if self.last_slot else self.start
+            self.last_slot = slot
+            return None, slot
+
+        while True:
+            slot, account_email = heapq.heappop(self._heap)
+            day = slot.date()
+            if self.used.get((account_email, day), 0) < self.daily_limit[account_email]:
+                break
+            # This account is full for the day; its next slot is at the start of tomorrow
+            heapq.heappush(self._heap, (datetime.combine(day + timedelta(days=1), datetime.min.time()), account_email))
+
+        self.used[(account_email, day)] = self.used.get((account_email, day), 0) + 1
+        heapq.heappush(self._heap, (slot + self.interval, account_email))
+        self.last_slot = slot if self.last_slot is None else max(self.last_slot, slot)
+        return account_email, slot
+
+def tracking_pixel_tag(uid):
+    return f'<img src=".../pixel.gif?uid={uid}" width="1" height="1">'
+
+TEMPLATE_FIELD_RE = re.compile(r'\{\{\s*(.*?)\s*\}\}')
+
+class CampaignTemplate:
+    """A campaign's subject and body with {{column}} placeholders, compiled once.
+
+    Queued emails store only the values of the referenced CSV columns, as a compact
+    JSON list in `fields` order (see pack), and are rendered when about to be sent.
+    Values are HTML-escaped in the body and inserted as-is in the subject. A campaign
+    without a body template only uses its subject template, filled in at import
+    (see subject_for), and its queued emails keep their own stored bodies.
+    """
+
+    def __init__(self, subject_template, body_template, track_opens=False):
+        self.track_opens = track_opens
+        self.has_body = bool(body_template)
+        self.fields = []
+        self._subject = self._compile(subject_template or '')
+        self._body = self._compile(body_template or '')
+
+    def _compile(self, text):
+        # split() alternates literal text and field names; store each name as its index in fields
+        parts = TEMPLATE_FIELD_RE.split(text)
+        for i in range(1, len(parts), 2):
+            if parts[i] not in self.fields:
+                self.fields.append(parts[i])
+            parts[i] = self.fields.index(parts[i])
+        return parts
+
+    @staticmethod
+    def _fill(parts, values):
+        return ''.join(part if i % 2 == 0 else values[part] for i, part in enumerate(parts))
+
+    def pack(self, row):
+        """The per-email variables for a CSV row."""
+        return json.dumps([row.get(field) or '' for field in self.fields],
+                          ensure_ascii=False, separators=(',', ':'))
+
+    def subject_for(self, row):
+        """The subject for a CSV row, or None when there is no subject template."""
+        return self._fill(self._subject, [row.get(field) or '' for field in self.fields]) or None
+
+    def add_pixel(self, uid, body):
+        return f"{body}\n{tracking_pixel_tag(uid)}" if self.track_opens else body
+
+    def render(self, uid, packed):
+        """Return (subject, body) for an email queued with pack()ed variables."""
+        values = json.loads(packed)
+        subject = self._fill(self._subject, values) or None
+        body = self._fill(self._body, [html.escape(value) for value in values])
+        return subject, self.add_pixel(uid, body)
+
+_campaign_templates = {}  # campaign id -> CampaignTemplate (campaigns never change once created)
+_campaign_templates_lock = threading.Lock()
+
+def campaign_template(conn, campaign_id):
+    with _campaign_templates_lock:
+        template = _campaign_templates.get(campaign_id)
+    if template is None:
+        row = conn.execute("SELECT subject_template, body_template, track_opens FROM campaigns WHERE id=?",
+                           (campaign_id,)).fetchone() or (None, None, 0)
+        template = CampaignTemplate(row[0], row[1], bool(row[2]))
+        with _campaign_templates_lock:
+            _campaign_templates[campaign_id] = template
+    return template
+
+_body_cache = OrderedDict()  # body hash -> decompressed body, most recently used last
+_body_cache_lock = threading.Lock()
+
+def email_body(conn, digest):
+    """Load a stored message body by hash; campaigns share bodies, so most loads are cache hits."""
+    with _body_cache_lock:
+        body = _body_cache.get(digest)
+        if body is not None:
+            _body_cache.move_to_end(digest)
+            return body
+    body = load_body(conn, digest) or ''
+    with _body_cache_lock:
+        _body_cache[digest] = body
+        if len(_body_cache) > BODY_CACHE_SIZE:
+            _body_cache.popitem(last=False)
+    return body
+
+def email_content(conn, campaign_id, uid, subject, digest, packed_vars):
+    """Subject and body of a queued email, from its campaign template or its stored body."""
+    template = campaign_template(conn, campaign_id)
+    if packed_vars is not None:
+        return template.render(uid, packed_vars)
+    return subject, template.add_pixel(uid, email_body(conn, digest))
+
+def lookup_hashes(conn, sql, hashes, params=()):
+    """Return the subset of hashes that `sql` (containing {placeholders}) finds, using chunked IN queries."""
+    hashes = list(hashes)
+    found = set()
+    for i in range(0, len(hashes), HASH_LOOKUP_CHUNK):
+        chunk = hashes[i:i + HASH_LOOKUP_CHUNK]
+        query = sql.format(placeholders=','.join('?' * len(chunk)))
+        found.update(row[0] for row in conn.execute(query, chunk + list(params)))
+    return found
+
+def suppressed_hashes(conn, hashes):
+    return lookup_hashes(conn, "SELECT addr_hash FROM suppressions WHERE addr_hash IN ({placeholders})", hashes)
+
+QUEUED_HASHES_SQL = "SELECT addr_hash FROM emails WHERE addr_hash IN ({placeholders})"
+# Left to itself the planner walks the whole campaign through idx_emails_campaign
+QUEUED_IN_CAMPAIGN_SQL = '''SELECT addr_hash FROM emails INDEXED BY idx_emails_addr_hash
+                            WHERE addr_hash IN ({placeholders}) AND campaign_id = ?'''
+
+def queued_hashes(conn, hashes, campaign_id=None):
+    """Hashes already in the emails table, in any campaign or only in campaign_id."""
+    if campaign_id is None:
+        return lookup_hashes(conn, QUEUED_HASHES_SQL, hashes)
+    return lookup_hashes(conn, QUEUED_IN_CAMPAIGN_SQL, hashes, (campaign_id,))
+
+def suppress_addresses(conn, addresses, reason):
+    """Add addresses to the suppression list (the caller commits). Returns how many were new."""
+    before = conn.total_changes
+    conn.executemany("INSERT OR IGNORE INTO suppressions (addr_hash, reason) VALUES (?, ?)",
+                     [(address_hash(address), reason) for address in addresses if address])
+    return conn.total_changes - before
+
+def ingest_campaign_rows(conn, reader, campaign_id, email_col, subject_col, msg_col,
+                         planner, template=None, rejects=None, batch_size=INGEST_BATCH_SIZE):
+    """Stream CSV rows into the emails queue using batched executemany on one connection.
+
+    Rows are pulled lazily from the reader, so memory stays bounded by batch_size.
+    Each batch is checked against the suppression list and the addresses already
+    queued (see DEDUP_ACROSS_CAMPAIGNS) with one indexed lookup each, and the rows
+    left get their account and send time from the SendPlanner. Message bodies go
+    to the content-addressed email_bodies table, once per distinct body; with a
+    CampaignTemplate that has a body only the row's template variables are stored
+    instead. Otherwise the subject comes from the template's subject, if any, or
+    from subject_col.
+    Tracking pixels are added at render time. Skipped rows are appended to `rejects`
+    as (position in reader, reason). The caller owns the transaction and commits.
+    Returns (inserted, elapsed_seconds).
+    """
+    started = time.perf_counter()
+    inserted = 0
+    batch = []
+    bodies = {}  # body -> hash, for bodies not yet written
+    stored = set()  # hashes recently written, so repeated bodies aren't recompressed
+
+    def reject(position, reason):
+        if rejects is not None:
+            rejects.append((position, reason))
+
+    def flush():
+        nonlocal inserted
+        hashes = {pending[1] for pending in batch}
+        blocked = suppressed_hashes(conn, hashes)
+        queued = queued_hashes(conn, hashes, None if DEDUP_ACROSS_CAMPAIGNS else campaign_id)
+        rows = []
+        for position, addr_hash, email, subject, digest, packed_vars in batch:
+            if addr_hash in blocked:
+                reject(position, "address is on the suppression list")
+                continue
+            if addr_hash in queued:
+                reject(position, "address is already queued")
+                continue
+            queued.add(addr_hash)
+            planned_account, next_send_time = planner.next_slot()
+            rows.append((str(uuid.uuid4()), email, addr_hash, subject, digest, packed_vars,
+                         next_send_time, campaign_id, planned_account))
+
+        store_bodies(conn, [(digest, body) for body, digest in bodies.items()])
+        if len(stored) > INGEST_BODY_MEMORY:
+            stored.clear()
+        stored.update(bodies.values())
+        bodies.clear()
+        conn.executemany("INSERT INTO emails (uid, email, addr_hash, subject, body_hash, vars, next_send_time, campaign_id, planned_account) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         rows)
+        inserted += len(rows)
+        batch.clear()
+
+    for position, row in enumerate(reader):
+        email = (row.get(email_col) or '').strip()
+        if '@' not in email:
+            reject(position, f"no address in column {email_col!r}")
+            continue
+        if template is not None and template.has_body:
+            subject, digest, packed_vars = None, None, template.pack(row)
+        else:
+            subject = template.subject_for(row) if template is not None else None
+            if subject is None and subject_col:
+                subject = row.get(subject_col)  # Make subject optional
+            msg = row.get(msg_col)
+            if not msg:
+                reject(position, f"no message in column {msg_col!r}")
+                continue
+            packed_vars = None
+            digest = bodies.get(msg)
+            if digest is None:
+                digest = body_hash(msg)
+                if digest not in stored:
+                    bodies[msg] = digest
+
+        batch.append((position, address_hash(email), email, subject, digest, packed_vars))
+        if len(batch) >= batch_size:
+            flush()
+
+    if batch:
+        flush()
+
+    return inserted, time.perf_counter() - started
+
+IMPORT_ERRORS_SHOWN = 100  # per-row errors included in /imports/<id>
+IMPORT_LEASE_SECONDS = 300  # an import whose runner stops renewing its lease this long is resumed elsewhere
+
+import_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='import')
+atexit.register(lambda: import_executor.shutdown(wait=False))
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def create_import_job(conn, kind, filename, params, campaign_id=None):
+    cursor = conn.execute("INSERT INTO import_jobs (kind, filename, params, campaign_id) VALUES (?, ?, ?, ?)",
+                          (kind, filename, json.dumps(params), campaign_id))
+    return cursor.lastrowid
+
+def start_import(job_id):
+    import_executor.submit(run_import_job, job_id)
+
+class ImportLeaseLost(Exception):
+    """Another process took over an import job after this one's lease expired."""
+
+def claim_import_job(conn, job_id):
+    """Lease an unfinished import job to this process, unless another live process holds it."""
+    now = datetime.utcnow()
+    cursor = conn.execute('''UPDATE import_jobs SET status = 'running', lease_owner = ?, lease_expires = ?, updated_at = ?
+                             WHERE id = ? AND status IN ('queued', 'running')
+                             AND (lease_owner IS NULL OR lease_owner = ? OR lease_expires <= ?)''',
+                          (WORKER_ID, now + timedelta(seconds=IMPORT_LEASE_SECONDS), now, job_id, WORKER_ID, now))
+    return cursor.rowcount == 1
+
+def resume_import_jobs():
+    """Restart imports that were queued or cut off by a restart, from their last committed row.
+
+    Jobs leased to a live process are left alone. Runs every IMPORT_LEASE_SECONDS, so
+    a job whose process died is picked up once its lease expires.
+    """
+    with get_connection() as conn:
+        job_ids = [row[0] for row in conn.execute(
+            '''SELECT id FROM import_jobs WHERE status IN ('queued', 'running')
+               AND (lease_expires IS NULL OR lease_expires <= ?) ORDER BY id''', (datetime.utcnow(),))]
+    for job_id in job_ids:
+        print(f"[IMPORT] Resuming import job {job_id}")
+        start_import(job_id)
+    return len(job_ids)
+
+def commit_import_batch(conn, job_id, read, inserted, errors):
+    """Record one batch's progress in the same transaction as the rows it inserted.
+
+    This also renews the process's lease on the job. If another process has taken the
+    job over, the batch is rolled back and ImportLeaseLost raised instead.
+    """
+    now = datetime.utcnow()
+    cursor = conn.execute('''UPDATE import_jobs SET rows_read = rows_read + ?, inserted = inserted + ?,
+                             rejected = rejected + ?, updated_at = ?, lease_expires = ?
+                             WHERE id = ? AND lease_owner = ?''',
+                          (read, inserted, len(errors), now, now + timedelta(seconds=IMPORT_LEASE_SECONDS),
+                           job_id, WORKER_ID))
+    if cursor.rowcount == 0:
+        conn.rollback()
+        raise ImportLeaseLost(job_id)
+    conn.executemany("INSERT INTO import_errors (job_id, row_number, error) VALUES (?, ?, ?)",
+                     [(job_id, row_number, error) for row_number, error in errors])
+    conn.commit()
+
+def import_leads(conn, job_id, rows, params, campaign_id):
+    """Queue a campaign's leads batch by batch; rows are (row number, CSV row) pairs."""
+    template = campaign_template(conn, campaign_id)
+    # Plan sends against each account's remaining capacity and queue (including
+    # whatever an interrupted run of this job already queued)
+    planner = SendPlanner(conn)
+    for chunk in chunked(rows, INGEST_BATCH_SIZE):
+        rejects = []
+        inserted, _ = ingest_campaign_rows(conn, [row for _, row in chunk], campaign_id, params['email_col'],
+                                           params.get('subject_col'), params.get('msg_col'), planner, template, rejects)
+        bump_campaign_stat(conn, campaign_id, 'total', inserted)
+        if planner.last_slot is not None:
+            conn.execute("UPDATE campaigns SET projected_completion=? WHERE id=?", (planner.last_slot, campaign_id))
+        # Wake the sender (in this or another process) so the campaign starts while the
+        # rest is still importing
+        bump_signal(conn, 'queue')
+        commit_import_batch(conn, job_id, len(chunk), inserted,
+                            [(chunk[position][0], reason) for position, reason in rejects])
+        send_scheduler.notify()
+
+def account_values(row):
+    """Validate one accounts CSV row into INSERT parameters; raises ValueError saying what is wrong."""
+    missing = [column for column in ('Email', 'SMTP Host', 'SMTP Port', 'Daily Limit') if not row.get(column)]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    numbers = {}
+    for column in ('SMTP Port', 'IMAP Port', 'Daily Limit'):
+        try:
+            numbers[column] = int(row[column]) if row.get(column) else None
+        except ValueError:
+            raise ValueError(f"{column} is not a number: {row[column]!r}")
+    # Optional: log the SMTP/IMAP conversation for this account
+    protocol_debug = (row.get('Protocol Debug') or '').strip().lower() in ('1', 'yes', 'true', 'y')
+    return (row['Email'], row['SMTP Host'], numbers['SMTP Port'], row.get('SMTP Username'), row.get('SMTP Password'),
+            row.get('IMAP Host'), numbers['IMAP Port'], row.get('IMAP Username'), row.get('IMAP Password'),
+            numbers['Daily Limit'], int(protocol_debug))
+
+def import_accounts(conn, job_id, rows, params, campaign_id):
+    """Insert or update sending accounts batch by batch; rows are (row number, CSV row) pairs."""
+    for chunk in chunked(rows, INGEST_BATCH_SIZE):
+        values, errors = [], []
+        for row_number, row in chunk:
+            try:
+                values.append(account_values(row))
+            except ValueError as e:
+                errors.append((row_number, str(e)))
+        conn.executemany('''INSERT OR REPLACE INTO accounts (
+            email, smtp_host, smtp_port, smtp_user, smtp_pass,
+            imap_host, imap_port, imap_user, imap_pass, daily_limit, protocol_debug
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', values)
+        bump_signal(conn, 'accounts')
+        commit_import_batch(conn, job_id, len(chunk), len(values), errors)
+    account_quotas.reload()
+    send_scheduler.notify()
+
+def import_suppressions(conn, job_id, rows, params, campaign_id):
+    """Add addresses to the suppression list; rows are (row number, CSV row) pairs.
+
+    Uses the Email column, or the first column if there is none. Emails already
+    queued to these addresses are dropped when they are next claimed.
+    """
+    for chunk in chunked(rows, INGEST_BATCH_SIZE):
+        addresses, errors = [], []
+        for row_number, row in chunk:
+            address = (row.get('Email') or row.get('email') or next(iter(row.values()), None) or '').strip()
+            if '@' in address:
+                addresses.append(address)
+            else:
+                errors.append((row_number, f"not an email address: {address!r}"))
+        suppress_addresses(conn, addresses, params.get('reason', 'manual'))
+        commit_import_batch(conn, job_id, len(chunk), len(addresses), errors)
+
+IMPORTERS = {
+    'leads': import_leads,
+    'accounts': import_accounts,
+    'suppressions': import_suppressions,
+}
+
+def run_import_job(job_id):
+    """Run (or resume) an import job on the import worker thread."""
+    with get_connection() as conn:
+        claimed = claim_import_job(conn, job_id)
+        conn.commit()
+        if not claimed:
+            print(f"[IMPORT] Job {job_id} is finished or running in another process")
+            return
+        kind, filename, params, campaign_id, offset = conn.execute(
+            "SELECT kind, filename, params, campaign_id, rows_read FROM import_jobs WHERE id=?", (job_id,)).fetchone()
+        started = time.perf_counter()
+        try:
+            with open(os.path.join(app.config['UPLOAD_FOLDER'], filename), newline='', encoding='utf-8-sig') as csvfile:
+                # Row numbers count data rows from 1; skip the ones a previous run committed
+                rows = enumerate(itertools.islice(csv.DictReader(csvfile), offset, None), start=offset + 1)
+                IMPORTERS[kind](conn, job_id, rows, json.loads(params), campaign_id)
+            conn.execute('''UPDATE import_jobs SET status='done', lease_owner=NULL, lease_expires=NULL, updated_at=?
+                            WHERE id=? AND lease_owner=?''', (datetime.utcnow(), job_id, WORKER_ID))
+            conn.commit()
+        except ImportLeaseLost:
+            print(f"[IMPORT] Job {job_id} was taken over by another process")
+            return
+        except Exception as e:
+            conn.rollback()
+            print(f"[ERROR] Import job {job_id} failed: {e}")
+            conn.execute('''UPDATE import_jobs SET status='failed', error=?, lease_owner=NULL, lease_expires=NULL,
+                            updated_at=? WHERE id=? AND lease_owner=?''', (str(e), datetime.utcnow(), job_id, WORKER_ID))
+            conn.commit()
+            return
+        read, inserted, rejected = conn.execute(
+            "SELECT rows_read, inserted, rejected FROM import_jobs WHERE id=?", (job_id,)).fetchone()
+    elapsed = time.perf_counter() - started
+    rate = (read - offset) / elapsed if elapsed > 0 else float(read - offset)
+    print(f"[IMPORT] Job {job_id} ({kind}) done: {inserted} inserted, {rejected} rejected of {read} rows "
+          f"in {elapsed:.2f}s ({rate:.0f} rows/sec)")
+
+def import_job_status(conn, job_id):
+    row = conn.execute('''SELECT id, kind, filename, campaign_id, status, rows_read, inserted, rejected, error,
+                           created_at, updated_at FROM import_jobs WHERE id=?''', (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(zip(('id', 'kind', 'filename', 'campaign_id', 'status', 'rows_read', 'inserted', 'rejected',
+                    'error', 'created_at', 'updated_at'), row))
+    job['errors'] = [{'row': row_number, 'error': error} for row_number, error in conn.execute(
+        "SELECT row_number, error FROM import_errors WHERE job_id=? ORDER BY row_number LIMIT ?",
+        (job_id, IMPORT_ERRORS_SHOWN))]
+    return job
+
+@app.route('/imports/<int:job_id>')
+def import_progress(job_id):
+    with get_connection() as conn:
+        job = import_job_status(conn, job_id)
+    if job is None:
+        return jsonify({'error': 'no such import job'}), 404
+    return jsonify(job)
+
 @app.route('/select', methods=['POST'])
 def select_columns():
     try:
         email_col = request.form['email_col']
-        subject_col = request.form['subject_col']
-        msg_col = request.form['msg_col']
+        subject_col = request.form.get('subject_col')
+        msg_col = request.form.get('msg_col')
+        subject_template = request.form.get('subject_template', '').strip()
+        body_template = request.form.get('body_template', '').strip()
         filename = request.form['filename']
         campaign_name = request.form.get('campaign_name', f"Campaign {datetime.now().strftime('%Y-%m-%d %H:%M')}")
         enable_tracking = request.form.get('enable_tracking', 'on') == 'on'  # Default to on if not specified
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
 
-        # Create new campaign
-        with sqlite3.connect(DB_PATH) as conn: 
-            cursor = conn.execute("INSERT INTO campaigns (name) VALUES (?)", (campaign_name,))
+        # A body template replaces the message column. The subject comes from either a
+        # subject column or a subject template, which also works with a message column.
+        if not body_template and not msg_col:
+            return "Choose a message column or write a body template.", 400
+        if subject_col and subject_template:
+            return "Choose a subject column or write a subject template, not both.", 400
+        if subject_col and body_template:
+            # Templated emails store only their variables, so the column becomes the template
+            subject_template = f"{{{{{subject_col}}}}}"
+        template = CampaignTemplate(subject_template, body_template, enable_tracking)
+
+        if template.fields:
+            with open(filepath, newline='', encoding='utf-8-sig') as csvfile:
+                fieldnames = csv.DictReader(csvfile).fieldnames or []
+            unknown = [field for field in template.fields if field not in fieldnames]
+            if unknown:
+                return f"Template refers to unknown columns: {', '.join(unknown)}", 400
+
+        # The rows themselves are queued by a background import job (see /imports/<id>)
+        with get_connection() as conn:
+            cursor = conn.execute("INSERT INTO campaigns (name, subject_template, body_template, track_opens) VALUES (?, ?, ?, ?)",
+                                  (campaign_name, subject_template or None, body_template or None, int(enable_tracking)))
             campaign_id = cursor.lastrowid
+            job_id = create_import_job(conn, 'leads', filename, {
+                'email_col': email_col, 'subject_col': subject_col, 'msg_col': msg_col}, campaign_id)
             conn.commit()
-
-        inserted = 0
-        with open(filepath, newline='', encoding='utf-8-sig') as csvfile:
-            reader = csv.DictReader(csvfile)
-            rows = list(reader)  # Read all rows first
-            
-            # Get number of available accounts
-            with sqlite3.connect(DB_PATH) as conn:
-                available_accounts = conn.execute("SELECT COUNT(*) FROM accounts").fetchone()[0]
-            
-            for i, row in enumerate(rows):
-                uid = str(uuid.uuid4())
-                email = row.get(email_col)
-                subject = row.get(subject_col) if subject_col else None  # Make subject optional
-                msg = row.get(msg_col)
-                if not email or not msg:
-                    continue
-                
-                # Add tracking pixel if enabled
-                if enable_tracking:
-                    tracking_pixel = f'<img src=".../pixel.gif?uid={uid}" width="1" height="1">'
-                    msg = f"{msg}\n{tracking_pixel}"
-                
-                # Calculate which batch this email is in
-                batch_number = i // available_accounts
-                next_send_time = datetime.utcnow() + timedelta(minutes=batch_number * SEND_INTERVAL_MINUTES)
-                
-                with sqlite3.connect(DB_PATH) as conn:
-                    conn.execute("INSERT INTO emails (uid, email, subject, message, next_send_time, campaign_id) VALUES (?, ?, ?, ?, ?, ?)", 
-                               (uid, email, subject, msg, next_send_time, campaign_id))
-                    conn.commit()
-                    inserted += 1
-
-        print(f"[SELECT] Inserted {inserted} emails into queue for campaign {campaign_name}")
+        start_import(job_id)
+        print(f"[SELECT] Queued import job {job_id} for campaign {campaign_name}")
         return redirect('/dashboard')
     except Exception as e:
         print(f"[ERROR] Failed to process file: {e}")
@@ -196,464 +678,1806 @@ def upload_accounts():
     filename = f"{base_name}_{timestamp}{ext}"
     filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
     file.save(filepath)
-    with open(filepath, newline='', encoding='utf-8-sig') as csvfile:
-        reader = csv.DictReader(csvfile)
-        with sqlite3.connect(DB_PATH) as conn:
-            for row in reader:
-                conn.execute('''INSERT OR REPLACE INTO accounts (
-                    email, smtp_host, smtp_port, smtp_user, smtp_pass,
-                    imap_host, imap_port, imap_user, imap_pass, daily_limit
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', (
-                    row['Email'],
-                    row['SMTP Host'],
-                    int(row['SMTP Port']),
-                    row['SMTP Username'],
-                    row['SMTP Password'],
-                    row['IMAP Host'],
-                    int(row['IMAP Port']),
-                    row['IMAP Username'],
-                    row['IMAP Password'],
-                    int(row['Daily Limit'])
-                ))
-            conn.commit()
-    return "Accounts uploaded."
+    # Parsed and inserted by a background import job (see /imports/<id>)
+    with get_connection() as conn:
+        job_id = create_import_job(conn, 'accounts', filename, {})
+        conn.commit()
+    start_import(job_id)
+    return redirect('/dashboard')
+
+@app.route('/suppressions_upload', methods=['POST'])
+def upload_suppressions():
+    file = request.files['file']
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    base_name, ext = os.path.splitext(secure_filename(file.filename))
+    filename = f"{base_name}_{timestamp}{ext}"
+    file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    with get_connection() as conn:
+        job_id = create_import_job(conn, 'suppressions', filename, {'reason': 'manual'})
+        conn.commit()
+    start_import(job_id)
+    return redirect('/dashboard')
+
+class TokenBucket:
+    """Classic token bucket: `rate` sends per `period` seconds, bursting up to `rate`."""
+
+    def __init__(self, rate, period):
+        self.capacity = float(rate)
+        self.tokens = float(rate)
+        self.fill_rate = rate / period
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until one token is available (0 if one is available now)."""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.fill_rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+def make_buckets(per_hour, per_minute):
+    buckets = []
+    if per_hour:
+        buckets.append(TokenBucket(per_hour, 3600))
+    if per_minute:
+        buckets.append(TokenBucket(per_minute, 60))
+    return buckets
+
+class AccountQuota:
+    def __init__(self, row):
+        self.row = row
+        self.sent_today = 0
+        self.day = None
+        self.cooldown_until = None
+        self.buckets = make_buckets(ACCOUNT_HOURLY_LIMIT, ACCOUNT_MINUTE_LIMIT)
+        self.dirty = False
+
+class QuotaManager:
+    """In-process send quotas for every row in the accounts table.
+
+    Daily counters reset lazily the first time an account is looked at on a new UTC
+    day (the day SendPlanner plans against), optional per-hour/per-minute token
+    buckets throttle each account and each SMTP host, and counters are written back
+    to SQLite by flush() rather than on every send. Each account should be owned by one sender process (see the sharding in
+    the sender entry point), since the counters are not shared between processes.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._accounts = {}  # account email -> AccountQuota
+        self._hosts = {}  # smtp host -> list of TokenBucket
+        self._loaded_at = None
+
+    def reload(self):
+        """Pick up added, removed or edited accounts while keeping in-memory counters."""
+        with get_connection() as conn:
+            rows = [row for row in conn.execute("SELECT * FROM accounts") if owns_account(row[1])]
+        with self._lock:
+            accounts = {}
+            for row in rows:
+                quota = self._accounts.get(row[1]) or AccountQuota(row)
+                if quota.day is None:
+                    # First load: trust what the database says about today
+                    quota.day = date.fromisoformat(row[11]) if row[11] else datetime.utcnow().date()
+                    quota.sent_today = row[12] or 0
+                quota.row = row
+                accounts[row[1]] = quota
+                if row[2] not in self._hosts:
+                    self._hosts[row[2]] = make_buckets(HOST_HOURLY_LIMIT, HOST_MINUTE_LIMIT)
+            self._accounts = accounts
+            self._loaded_at = time.monotonic()
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > QUOTA_RELOAD_SECONDS:
+            self.reload()
+
+    def _roll_day(self, quota, today):
+        if quota.day != today:
+            quota.day = today
+            quota.sent_today = 0
+            quota.dirty = True
+
+    def _ready_at(self, quota, now):
+        buckets = quota.buckets + self._hosts.get(quota.row[2], [])
+        wait = max([bucket.wait_time() for bucket in buckets] or [0])
+        ready = now + timedelta(seconds=wait)
+        if quota.cooldown_until and quota.cooldown_until > ready:
+            ready = quota.cooldown_until
+        return ready
+
+    def accounts(self, include_waiting=False):
+        """Accounts with daily quota left, least used first.
+
+        Unless include_waiting is set, accounts that are cooling down or out of
+        hourly/minute tokens are left out.
+        """
+        self._ensure_loaded()
+        now = datetime.utcnow()
+        today = now.date()
+        with self._lock:
+            available = []
+            for quota in self._accounts.values():
+                self._roll_day(quota, today)
+                if quota.sent_today >= (quota.row[10] or 0):
+                    continue
+                if include_waiting or self._ready_at(quota, now) <= now:
+                    available.append(quota)
+            available.sort(key=lambda quota: quota.sent_today)
+            return [quota.row for quota in available]
+
+    def ready_at(self, account):
+        """UTC time at which the account may send again (now if it may send right away)."""
+        with self._lock:
+            quota = self._accounts.get(account[1])
+            now = datetime.utcnow()
+            return self._ready_at(quota, now) if quota else now
+
+    def acquire(self, account):
+        """Take one send's worth of hourly/minute tokens; False if the account or host is throttled."""
+        with self._lock:
+            quota = self._accounts.get(account[1])
+            if quota is None:
+                return True
+            buckets = quota.buckets + self._hosts.get(account[2], [])
+            if any(bucket.wait_time() > 0 for bucket in buckets):
+                return False
+            for bucket in buckets:
+                bucket.consume()
+            return True
+
+    def refund(self, account):
+        """Give back the tokens of a send that failed."""
+        with self._lock:
+            quota = self._accounts.get(account[1])
+            if quota is not None:
+                for bucket in quota.buckets + self._hosts.get(account[2], []):
+                    bucket.refund()
+
+    def record_send(self, account, cooldown=True):
+        with self._lock:
+            quota = self._accounts.get(account[1])
+            if quota is None:
+                return
+            self._roll_day(quota, datetime.utcnow().date())
+            quota.sent_today += 1
+            quota.dirty = True
+            if cooldown:
+                # Randomized gap between two sends from the same account
+                quota.cooldown_until = datetime.utcnow() + timedelta(
+                    minutes=random.uniform(MIN_WAIT_MINUTES, MAX_WAIT_MINUTES))
+
+    def flush(self):
+        """Write changed daily counters back to the accounts table in one transaction."""
+        with self._lock:
+            dirty = [quota for quota in self._accounts.values() if quota.dirty]
+            updates = [(quota.day, quota.sent_today, quota.row[1]) for quota in dirty]
+            for quota in dirty:
+                quota.dirty = False
+        if not updates:
+            return 0
+        try:
+            writer.submit(lambda conn: conn.executemany("UPDATE accounts SET last_sent=?, sent_today=? WHERE email=?",
+                                                        updates)).result()
+        except Exception:
+            with self._lock:
+                for quota in dirty:
+                    quota.dirty = True
+            raise
+        return len(updates)
+
+    def owned(self):
+        """{account email: accounts row} for every account this process sends for, quota or not."""
+        self._ensure_loaded()
+        with self._lock:
+            return {email: quota.row for email, quota in self._accounts.items()}
+
+    def usage(self):
+        """{account email: (sent today, daily limit)} for the accounts this process sends for."""
+        with self._lock:
+            return {email: (quota.sent_today, quota.row[10] or 0) for email, quota in self._accounts.items()}
+
+account_quotas = QuotaManager()
+atexit.register(account_quotas.flush)
+
+def register_quota_metrics():
+    """Per-account quota gauges; only the sender process has live counters, so it registers these."""
+    registry.gauge('account_sent_today', "Emails sent by the account today", ['account'],
+                   callback=lambda: {(email,): sent for email, (sent, limit) in account_quotas.usage().items()})
+    registry.gauge('account_daily_limit', "Daily send limit of the account", ['account'],
+                   callback=lambda: {(email,): limit for email, (sent, limit) in account_quotas.usage().items()})
 
 def get_available_accounts():
-    today = date.today()
-    with sqlite3.connect(DB_PATH) as conn:
-        rows = conn.execute('''SELECT * FROM accounts
-                               WHERE (last_sent IS NULL OR last_sent < ? OR sent_today < daily_limit)
-                               ORDER BY sent_today ASC''', (today,)).fetchall()
-        if not rows:
-            return None
-        
-        # Update last_sent date for accounts that need it
-        for account in rows:
-            if account[11] != today:
-                conn.execute("UPDATE accounts SET last_sent=?, sent_today=0 WHERE id=?", (today, account[0]))
+    """Accounts that may send right now, least used first (None if there are none)."""
+    return account_quotas.accounts() or None
+
+SMTP_CONNECT_SECONDS = registry.histogram('smtp_connect_seconds', "Time to open an SMTP connection", ['host'])
+SMTP_LOGIN_SECONDS = registry.histogram('smtp_login_seconds', "Time to authenticate an SMTP session", ['host'])
+SMTP_SEND_SECONDS = registry.histogram('smtp_send_seconds', "Time for the server to accept one message", ['host'])
+SMTP_RECONNECTS = registry.counter('smtp_reconnects_total', "Pooled SMTP sessions that dropped mid-send", ['host'])
+
+def protocol_debug(account):
+    """Whether the account opted in to SMTP/IMAP protocol traces (accounts.protocol_debug)."""
+    return len(account) > 13 and bool(account[13])
+
+class PooledSMTPSession:
+    """An authenticated SMTP_SSL connection plus the bookkeeping the pool needs."""
+
+    def __init__(self, server):
+        self.server = server
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.sent = 0
+
+    def close(self):
+        try:
+            self.server.quit()
+        except Exception:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+
+class SMTPConnectionPool:
+    """Keeps up to `size` logged-in SMTP sessions per account alive between sends.
+
+    Sessions are reused across scheduler ticks, NOOP-probed when they have been idle,
+    recycled once they get old or have sent enough messages, and reconnected on failure.
+    """
+
+    def __init__(self, size=SMTP_POOL_SIZE, noop_after=SMTP_NOOP_AFTER_SECONDS,
+                 max_age=SMTP_MAX_SESSION_AGE, max_messages=SMTP_MAX_MESSAGES_PER_SESSION):
+        self.size = size
+        self.noop_after = noop_after
+        self.max_age = max_age
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        self._idle = {}  # account key -> list of idle PooledSMTPSession
+        self._slots = {}  # account key -> BoundedSemaphore limiting open sessions
+
+    @staticmethod
+    def _key(account):
+        # accounts row: id, email, smtp_host, smtp_port, smtp_user, smtp_pass, ...
+        return (account[1], account[2], account[3], account[4])
+
+    def _connect(self, account):
+        print(f"[SMTP POOL] Opening session for {account[1]} ({account[2]}:{account[3]})")
+        with SMTP_CONNECT_SECONDS.time(host=account[2]):
+            server = smtplib.SMTP_SSL(account[2], account[3], timeout=10)
+        try:
+            if protocol_debug(account):
+                server.set_debuglevel(1)
+            with SMTP_LOGIN_SECONDS.time(host=account[2]):
+                server.login(account[4], account[5])
+        except Exception:
+            server.close()
+            raise
+        return PooledSMTPSession(server)
+
+    def _is_usable(self, session):
+        now = time.monotonic()
+        if now - session.created > self.max_age or session.sent >= self.max_messages:
+            return False
+        if now - session.last_used > self.noop_after:
+            try:
+                code, _ = session.server.noop()
+                return code == 250
+            except Exception:
+                return False
+        return True
+
+    def _checkout(self, account):
+        key = self._key(account)
+        with self._lock:
+            slots = self._slots.setdefault(key, threading.BoundedSemaphore(self.size))
+        slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    idle = self._idle.get(key)
+                    session = idle.pop() if idle else None
+                if session is None:
+                    return self._connect(account)
+                if self._is_usable(session):
+                    return session
+                print(f"[SMTP POOL] Recycling stale session for {account[1]}")
+                session.close()
+        except Exception:
+            slots.release()
+            raise
+
+    def _checkin(self, account, session, reusable=True):
+        key = self._key(account)
+        if reusable:
+            session.last_used = time.monotonic()
+            with self._lock:
+                self._idle.setdefault(key, []).append(session)
+        else:
+            session.close()
+        self._slots[key].release()
+
+    @staticmethod
+    def _transmit(server, sender, to_addrs, msg, progress):
+        """sendmail() split at DATA, so the caller knows whether the server may already have the
+        message: progress['data'] is set just before DATA is sent."""
+        def reset():
+            # Best effort: the refusal is what the caller needs to see
+            try:
+                server.rset()
+            except OSError:
+                pass
+
+        server.ehlo_or_helo_if_needed()
+        code, resp = server.mail(sender)
+        if code != 250:
+            reset()
+            raise smtplib.SMTPSenderRefused(code, resp, sender)
+        refused = {}
+        for addr in to_addrs:
+            code, resp = server.rcpt(addr)
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+        if len(refused) == len(to_addrs):
+            reset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        progress['data'] = True
+        code, resp = server.data(msg)
+        if code != 250:
+            reset()
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    def send(self, account, msg, to_addrs=None):
+        """Send msg through a pooled session for account, reconnecting once if the session died.
+
+        msg is either an email.message.Message or already-serialized bytes, in which
+        case to_addrs must list the envelope recipients. Only a connection lost before
+        DATA is retried; after that the server may have accepted the message, and
+        resending could deliver it twice.
+        """
+        if not isinstance(msg, bytes):
+            to_addrs = to_addrs or [addr for _, addr in email.utils.getaddresses(
+                msg.get_all('To', []) + msg.get_all('Cc', []) + msg.get_all('Bcc', []))]
+            del msg['Bcc']
+            msg = msg.as_bytes(policy=msg.policy.clone(linesep='\r\n'))
+        for attempt in range(2):
+            session = self._checkout(account)
+            progress = {'data': False}
+            try:
+                with SMTP_SEND_SECONDS.time(host=account[2]):
+                    self._transmit(session.server, account[1], to_addrs, msg, progress)
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException):
+                # Server rejected this message but the session itself is still fine
+                self._checkin(account, session)
+                raise
+            except (smtplib.SMTPServerDisconnected, OSError) as e:
+                # Other SMTPExceptions are OSErrors too, but the response errors are handled above
+                self._checkin(account, session, reusable=False)
+                if attempt or progress['data']:
+                    raise
+                SMTP_RECONNECTS.inc(host=account[2])
+                print(f"[SMTP POOL] Session for {account[1]} dropped ({e}), reconnecting...")
+                continue
+            except Exception:
+                self._checkin(account, session, reusable=False)
+                raise
+            session.sent += 1
+            self._checkin(account, session)
+            return
+
+    def close_all(self):
+        with self._lock:
+            sessions = [session for idle in self._idle.values() for session in idle]
+            self._idle.clear()
+        for session in sessions:
+            session.close()
+
+smtp_pool = SMTPConnectionPool()
+atexit.register(smtp_pool.close_all)
+
+SEND_CONCURRENCY = 8  # max messages in flight at once across all accounts
+SEND_PER_HOST_LIMIT = 2  # max concurrent sends against a single SMTP host
+SEND_LEASE_SECONDS = 300  # how long a claimed email stays reserved for one worker
+SCHEDULER_LOOKAHEAD = 1000  # upcoming next_send_times kept in the scheduler's heap
+SCHEDULER_MAX_SLEEP = 300  # resync with the database at least this often (seconds)
+SCHEDULER_SIGNAL_POLL = 1  # check for work queued by other processes this often (seconds)
+PLAN_REASSIGN_AFTER_HOURS = 24  # planned emails this overdue may be sent by any account
+ACCOUNT_HOURLY_LIMIT = None  # optional max sends per account per hour
+ACCOUNT_MINUTE_LIMIT = None  # optional max sends per account per minute
+HOST_HOURLY_LIMIT = None  # optional max sends per SMTP host per hour (all accounts on it)
+HOST_MINUTE_LIMIT = None  # optional max sends per SMTP host per minute
+QUOTA_FLUSH_SECONDS = 30  # how often in-memory sent_today counters are written to SQLite
+QUOTA_RELOAD_SECONDS = 300  # how often the accounts table is re-read for changes
+RENDER_LOOKAHEAD_MINUTES = 60  # pre-render queued emails due within this window
+RENDER_BATCH_SIZE = 1000  # rows rendered per transaction
+RENDER_INTERVAL_SECONDS = 60  # how often the pre-render job looks for newly due emails
+REPLY_BATCH_SIZE = 50  # queued replies claimed per pass of the priority lane
+REPLY_MAX_ATTEMPTS = 5  # a reply that failed this often is marked failed
+REPLY_RETRY_SECONDS = 30  # first retry delay for a reply that failed temporarily (doubles each time)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"  # lease owner name for this process
+
+send_executor = ThreadPoolExecutor(max_workers=SEND_CONCURRENCY, thread_name_prefix='sender')
+atexit.register(lambda: send_executor.shutdown(wait=False))
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+def host_slot(smtp_host):
+    """Return the semaphore capping concurrent sends to one SMTP host."""
+    with _host_slots_lock:
+        if smtp_host not in _host_slots:
+            _host_slots[smtp_host] = threading.BoundedSemaphore(SEND_PER_HOST_LIMIT)
+        return _host_slots[smtp_host]
+
+def render_cold_email(to_email, subject, message):
+    """Serialize everything about a queued email except From and Message-ID, which
+    depend on the sending account and are stamped on by stamp_cold_email."""
+    full_msg = MIMEMultipart("alternative")
+    full_msg['Subject'] = subject or "Hello from Hengbin"
+    full_msg['To'] = to_email
+    full_msg.attach(MIMEText(message, 'html'))
+    return full_msg.as_bytes(policy=full_msg.policy.clone(linesep='\r\n'))
+
+def stamp_cold_email(account, rendered):
+    """Prepend From and a fresh Message-ID to rendered bytes. Returns (message bytes, message_id)."""
+    msg_id = f"{uuid.uuid4()}@{account[1].split('@')[1]}"
+    headers = f"From: {account[1]}\r\nMessage-ID: <{msg_id}>\r\n".encode()
+    return headers + rendered, msg_id
+
+def build_cold_email(account, to_email, subject, message):
+    """Render and stamp a queued email in one go. Returns (message bytes, message_id)."""
+    return stamp_cold_email(account, render_cold_email(to_email, subject, message))
+
+PRERENDER_SQL = '''SELECT id, uid, email, subject, body_hash, campaign_id, vars FROM emails
+                   WHERE sent_at IS NULL AND is_sending = 0
+                   AND rendered IS NULL AND next_send_time <= ?
+                   ORDER BY next_send_time LIMIT ?'''
+
+def prerender_due_emails(lookahead_minutes=RENDER_LOOKAHEAD_MINUTES, batch_size=RENDER_BATCH_SIZE):
+    """Render queued emails due within the lookahead window, so sending is just claim, stamp, transmit.
+
+    Rows that are still unrendered when they get claimed are rendered at send time instead.
+    """
+    horizon = datetime.utcnow() + timedelta(minutes=lookahead_minutes)
+    rendered = 0
+    with get_connection() as conn:
+        while True:
+            rows = conn.execute(PRERENDER_SQL, (horizon, batch_size)).fetchall()
+            if not rows:
+                break
+            updates = []
+            for id_, uid, to_addr, subject, digest, campaign_id, packed_vars in rows:
+                try:
+                    updates.append((render_cold_email(to_addr, *email_content(conn, campaign_id, uid, subject, digest,
+                                                                             packed_vars)), id_))
+                except Exception as e:
+                    # One bad row must not stall the rest of the batch (or every later run)
+                    print(f"[RENDER ERROR] Email {id_} to {to_addr} can't be rendered: {e}")
+                    fail_email(conn, id_, f"render failed: {e}")
+            conn.executemany("UPDATE emails SET rendered=? WHERE id=? AND sent_at IS NULL", updates)
+            conn.commit()
+            rendered += len(updates)
+    if rendered:
+        print(f"[RENDER] Pre-rendered {rendered} emails due before {horizon}")
+    return rendered
+
+CLAIM_SQL = '''UPDATE emails SET is_sending = 1, lease_owner = ?, lease_expires = ?
+               WHERE id = (SELECT id FROM emails
+                           WHERE sent_at IS NULL
+                           AND is_sending = 0
+                           AND {condition}
+                           AND next_send_time <= ?
+                           ORDER BY next_send_time
+                           LIMIT 1)
+               RETURNING id, uid, email, subject, body_hash, campaign_id, rendered, vars'''
+CLAIM_PLANNED = "planned_account = ?"
+CLAIM_ANY = "(planned_account IS NULL OR next_send_time <= ?)"
+
+def claim_ready_emails(conn, accounts, owner=WORKER_ID, lease_seconds=SEND_LEASE_SECONDS):
+    """Atomically lease at most one ready email to each account, on behalf of `owner`.
+
+    An account takes the emails planned for it first. Unplanned emails, and planned
+    ones overdue by more than PLAN_REASSIGN_AFTER_HOURS (e.g. their account was
+    removed), can go to any account. Each claim is a single UPDATE ... RETURNING
+    statement, so concurrent workers (threads or processes) never claim the same row.
+    Returns a list of (account, (id, uid, email, subject, body_hash, campaign_id, rendered, vars)) pairs.
+    """
+    now = datetime.utcnow()
+    expires = now + timedelta(seconds=lease_seconds)
+    overdue = now - timedelta(hours=PLAN_REASSIGN_AFTER_HOURS)
+    claims = []
+    for account in accounts:
+        row = conn.execute(CLAIM_SQL.format(condition=CLAIM_PLANNED),
+                           (owner, expires, account[1], now)).fetchone()
+        if row is None:
+            row = conn.execute(CLAIM_SQL.format(condition=CLAIM_ANY),
+                               (owner, expires, overdue, now)).fetchone()
+        if row is not None:
+            claims.append((account, row))
+    conn.commit()
+    return claims
+
+def release_lease(conn, email_id, owner=WORKER_ID):
+    """Return a claimed email to the queue, as long as `owner` still holds its lease."""
+    conn.execute('''UPDATE emails SET is_sending = 0, lease_owner = NULL, lease_expires = NULL
+                    WHERE id = ? AND lease_owner = ? AND sent_at IS NULL''', (email_id, owner))
+
+def drop_suppressed_email(conn, email_id):
+    """Take a queued email to a suppressed address off the queue (a NULL next_send_time is never due)."""
+    conn.execute('''UPDATE emails SET suppressed_at = ?, next_send_time = NULL, is_sending = 0,
+                    lease_owner = NULL, lease_expires = NULL, rendered = NULL
+                    WHERE id = ? AND sent_at IS NULL''', (datetime.utcnow(), email_id))
+
+def fail_email(conn, email_id, error):
+    """Take a queued email that can never be sent off the queue, keeping the reason."""
+    conn.execute('''UPDATE emails SET failed_at = ?, error = ?, next_send_time = NULL, is_sending = 0,
+                    lease_owner = NULL, lease_expires = NULL, rendered = NULL
+                    WHERE id = ? AND sent_at IS NULL''', (datetime.utcnow(), error, email_id))
+
+REAP_EMAILS_SQL = '''UPDATE emails SET is_sending = 0, lease_owner = NULL, lease_expires = NULL
+                     WHERE is_sending = 1 AND sent_at IS NULL
+                     AND (lease_expires IS NULL OR lease_expires <= ?)'''
+REAP_REPLIES_SQL = '''UPDATE outbound_replies SET status = 'queued', lease_owner = NULL, lease_expires = NULL
+                      WHERE status = 'sending' AND lease_expires <= ?'''
+
+def reap_expired_leases():
+    """Put emails whose lease expired (e.g. the worker died mid-send) back on the queue."""
+    with get_connection() as conn:
+        cursor = conn.execute(REAP_EMAILS_SQL, (datetime.utcnow(),))
+        replies = conn.execute(REAP_REPLIES_SQL, (datetime.utcnow(),))
         conn.commit()
-        
-        return rows
+    if cursor.rowcount or replies.rowcount:
+        print(f"[LEASE REAPER] Returned {cursor.rowcount} expired leases and {replies.rowcount} replies to the queue")
+        send_scheduler.notify_replies()
+        send_scheduler.notify()
+    return cursor.rowcount + replies.rowcount
+
+SEND_RESULTS = registry.counter('send_results_total', "Outcome of each claimed email", ['account', 'result'])
+
+def queue_depth():
+    """Emails due now that no worker has claimed yet."""
+    with get_connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM emails WHERE sent_at IS NULL AND is_sending = 0 AND next_send_time <= ?",
+                            (datetime.utcnow(),)).fetchone()[0]
+
+def queue_lag():
+    """Seconds the oldest due, unclaimed email has been waiting (0 if none is due)."""
+    with get_connection() as conn:
+        oldest = conn.execute("SELECT MIN(next_send_time) FROM emails WHERE sent_at IS NULL AND is_sending = 0 AND next_send_time <= ?",
+                              (datetime.utcnow(),)).fetchone()[0]
+    return max((datetime.utcnow() - datetime.fromisoformat(oldest)).total_seconds(), 0) if oldest else 0
+
+registry.gauge('queue_depth', "Emails due now and not yet claimed", callback=queue_depth)
+registry.gauge('queue_lag_seconds', "Now minus the oldest due next_send_time", callback=queue_lag)
+
+def deliver_email(account, to_email, full_msg):
+    """Worker-side half of a send: only network I/O, no database access."""
+    with host_slot(account[2]):
+        smtp_pool.send(account, full_msg, to_addrs=[to_email])
+
+SENT_RECORD_ATTEMPTS = 5  # tries at marking a delivered email sent before giving up
+
+def record_sent(conn, email_id, account_email, msg_id, campaign_id):
+    """Mark a delivered email sent, retrying on errors such as "database is locked".
+
+    The server has already accepted the message, so releasing the lease on a failed
+    write would send it again; only if every attempt fails is it left leased.
+    """
+    for attempt in range(SENT_RECORD_ATTEMPTS):
+        try:
+            conn.execute('''UPDATE emails SET sent_at=?, account_email=?, is_sending=0, message_id=?,
+                            lease_owner=NULL, lease_expires=NULL, rendered=NULL WHERE id=?''',
+                         (datetime.utcnow(), account_email, msg_id, email_id))
+            bump_campaign_stat(conn, campaign_id, 'sent')
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            print(f"[ERROR] Email {email_id} was sent but not recorded (attempt {attempt + 1}): {e}")
+            if attempt + 1 < SENT_RECORD_ATTEMPTS:
+                time.sleep(2 ** attempt)
+    return False
+
+def record_send_failure(conn, account, email_id, to_email, error):
+    """Requeue an email the server didn't take, or suppress its address if it bounced."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        print(f"[ERROR] {to_email} refused by {account[2]}: {error.recipients}")
+        if codes and all(code >= 500 for code in codes):
+            # Permanent failure: never try this address again
+            suppress_addresses(conn, [to_email], 'bounced')
+            drop_suppressed_email(conn, email_id)
+            SEND_RESULTS.inc(account=account[1], result='bounced')
+        else:
+            release_lease(conn, email_id)
+            SEND_RESULTS.inc(account=account[1], result='refused')
+    else:
+        print(f"[ERROR] Failed to send to {to_email} via {account[1]}: {error}")
+        release_lease(conn, email_id)
+        SEND_RESULTS.inc(account=account[1], result='failed')
+    conn.commit()
 
 def send_next_email():
-    print("[SCHEDULER] Checking for unsent emails...")
-    with sqlite3.connect(DB_PATH) as conn:
-        # Get all available accounts
-        accounts = get_available_accounts()
-        if not accounts:
-            print("[SCHEDULER] No available accounts with quota.")
-            return
+    """Send one due email from every account that has quota and isn't cooling down.
 
-        # For each available account, try to send one email
-        accounts = [accounts[2]]
-        print(accounts)
-        for account in accounts:
-            # Get the next email that's ready to send
-            now = datetime.utcnow()
-            row = conn.execute('''SELECT id, uid, email, subject, message FROM emails 
-                                WHERE sent_at IS NULL 
-                                AND next_send_time <= ? 
-                                AND is_sending = 0
-                                LIMIT 1''', (now,)).fetchone()
-            
-            if not row:
+    Returns the number of emails dispatched.
+    """
+    # Get all available accounts
+    accounts = get_available_accounts()
+    if not accounts:
+        return 0
+
+    with get_connection() as conn:
+        # Claim one ready email for each eligible account
+        claims = claim_ready_emails(conn, accounts)
+        if not claims:
+            return 0
+
+        # Addresses may have been suppressed (reply, bounce, manual) since they were queued
+        blocked = suppressed_hashes(conn, {address_hash(row[2]) for account, row in claims})
+
+        # Filter and render everything first, so nothing below can fail once messages are in flight
+        outgoing = []
+        for account, (id_, uid, to_email, subject, digest, campaign_id, rendered, packed_vars) in claims:
+            if blocked and address_hash(to_email) in blocked:
+                print(f"[SUPPRESSED] Dropping queued email {id_} to suppressed address {to_email}")
+                drop_suppressed_email(conn, id_)
+                SEND_RESULTS.inc(account=account[1], result='suppressed')
+                continue
+            if not account_quotas.acquire(account):
+                # Throttled since the account list was built (e.g. by a reply); retry later
+                release_lease(conn, id_)
+                SEND_RESULTS.inc(account=account[1], result='throttled')
+                continue
+            try:
+                if rendered is None:
+                    rendered = render_cold_email(to_email, *email_content(conn, campaign_id, uid, subject, digest, packed_vars))
+            except Exception as e:
+                print(f"[RENDER ERROR] Email {id_} to {to_email} can't be rendered: {e}")
+                fail_email(conn, id_, f"render failed: {e}")
+                account_quotas.refund(account)
+                SEND_RESULTS.inc(account=account[1], result='render_failed')
+                continue
+            outgoing.append((account, id_, to_email, campaign_id, rendered))
+        # Release the write lock before any SMTP round trip
+        conn.commit()
+
+        # Send in parallel; results are written back on this thread's connection
+        futures = {}
+        for account, id_, to_email, campaign_id, rendered in outgoing:
+            full_msg, msg_id = stamp_cold_email(account, rendered)
+            future = send_executor.submit(deliver_email, account, to_email, full_msg)
+            futures[future] = (account, id_, to_email, msg_id, campaign_id)
+
+        for future in as_completed(futures):
+            account, id_, to_email, msg_id, campaign_id = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                # Give the throttle tokens back, and the email unless it bounced
+                account_quotas.refund(account)
+                try:
+                    record_send_failure(conn, account, id_, to_email, e)
+                except Exception as db_error:
+                    conn.rollback()
+                    print(f"[ERROR] Couldn't requeue email {id_} ({db_error}); the lease reaper will")
                 continue
+            # Delivered: from here on the email must never go back on the queue
+            account_quotas.record_send(account)
+            SEND_RESULTS.inc(account=account[1], result='sent')
+            print(f"[SUCCESS] Sent to {to_email}")
+            record_sent(conn, id_, account[1], msg_id, campaign_id)
+
+        print(f"[SCHEDULER] Dispatched {len(futures)} emails, one per account")
+        return len(futures)
+
+REPLY_CLAIM_SQL = '''UPDATE outbound_replies SET status = 'sending', attempts = attempts + 1,
+                                                lease_owner = ?, lease_expires = ?
+                     WHERE id IN (SELECT id FROM outbound_replies
+                                  WHERE status = 'queued' AND account_email IN ({placeholders})
+                                  AND next_attempt_at <= ?
+                                  ORDER BY id LIMIT ?)
+                     RETURNING id, account_email, to_addr, message, message_id, inbox_account, in_reply_to, attempts'''
+NEXT_REPLY_RETRY_SQL = '''SELECT MIN(next_attempt_at) FROM outbound_replies
+                          WHERE status = 'queued' AND account_email IN ({placeholders})'''
+ORPHANED_REPLIES_SQL = '''UPDATE outbound_replies SET status = 'failed', error = 'sending account was removed'
+                          WHERE status = 'queued' AND account_email NOT IN (SELECT email FROM accounts)'''
 
-            id_, uid, to_email, subject, message = row
-            
-            # Mark email as being sent to prevent duplicate sends
-            conn.execute("UPDATE emails SET is_sending = 1 WHERE id = ?", (id_,))
+registry.gauge('reply_queue_depth', "Replies waiting on the priority lane",
+               callback=lambda: get_connection().execute(
+                   "SELECT COUNT(*) FROM outbound_replies WHERE status IN ('queued', 'sending')").fetchone()[0])
+
+def send_queued_replies(owner=WORKER_ID, lease_seconds=SEND_LEASE_SECONDS, limit=REPLY_BATCH_SIZE):
+    """Priority lane: deliver replies queued by /reply, each from the account its thread belongs to.
+
+    Replies skip the cold-email cooldown and throttles (a person is waiting on them)
+    but still count towards the account's sent_today. Temporary failures are retried
+    with backoff; permanent ones are marked failed with the server's answer.
+    Returns the UTC time the next retry is due, or None if nothing is waiting.
+    """
+    accounts = account_quotas.owned()
+    now = datetime.utcnow()
+    with get_connection() as conn:
+        claims = []
+        for chunk in chunked(accounts, HASH_LOOKUP_CHUNK):
+            claims.extend(conn.execute(REPLY_CLAIM_SQL.format(placeholders=','.join('?' * len(chunk))),
+                                       (owner, now + timedelta(seconds=lease_seconds), *chunk, now, limit)).fetchall())
+        conn.commit()
+
+        futures = {}
+        for claim in claims:
+            reply_id, account_email, to_addr, message = claim[:4]
+            futures[send_executor.submit(deliver_email, accounts[account_email], to_addr, message)] = claim
+
+        threads_replied = []
+        for future in as_completed(futures):
+            reply_id, account_email, to_addr, message, message_id, inbox_account, in_reply_to, attempts = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                permanent = isinstance(e, smtplib.SMTPResponseException) and e.smtp_code >= 500
+                if isinstance(e, smtplib.SMTPRecipientsRefused):
+                    permanent = all(code >= 500 for code, _ in e.recipients.values())
+                if permanent or attempts >= REPLY_MAX_ATTEMPTS:
+                    print(f"[REPLY ERROR] Giving up on reply {reply_id} to {to_addr} via {account_email}: {e}")
+                    conn.execute('''UPDATE outbound_replies SET status = 'failed', error = ?,
+                                    lease_owner = NULL, lease_expires = NULL WHERE id = ?''', (str(e), reply_id))
+                    SEND_RESULTS.inc(account=account_email, result='reply_failed')
+                else:
+                    retry_at = datetime.utcnow() + timedelta(seconds=REPLY_RETRY_SECONDS * 2 ** (attempts - 1))
+                    print(f"[REPLY ERROR] Reply {reply_id} to {to_addr} via {account_email} failed ({e}), retrying at {retry_at}")
+                    conn.execute('''UPDATE outbound_replies SET status = 'queued', error = ?, next_attempt_at = ?,
+                                    lease_owner = NULL, lease_expires = NULL WHERE id = ?''', (str(e), retry_at, reply_id))
+                    SEND_RESULTS.inc(account=account_email, result='reply_retry')
+            else:
+                conn.execute('''UPDATE outbound_replies SET status = 'sent', sent_at = ?, error = NULL,
+                                lease_owner = NULL, lease_expires = NULL WHERE id = ?''', (datetime.utcnow(), reply_id))
+                account_quotas.record_send(accounts[account_email], cooldown=False)
+                SEND_RESULTS.inc(account=account_email, result='reply_sent')
+                print(f"[REPLY] Sent reply {reply_id} to {to_addr} via {account_email}")
+                if inbox_account and in_reply_to:
+                    threads_replied.append((inbox_account, in_reply_to))
             conn.commit()
 
-            smtp_host = account[2]
-            smtp_port = account[3]
-            smtp_user = account[4]
-            smtp_pass = account[5]
-
-            full_msg = MIMEMultipart("alternative")
-            full_msg['Subject'] = subject or "Hello from Hengbin"
-            full_msg['From'] = account[1]
-            full_msg['To'] = to_email
-            
-            # Generate a proper Message-ID
-            msg_id = f"{uuid.uuid4()}@{account[1].split('@')[1]}"
-            full_msg['Message-ID'] = f"<{msg_id}>"
-            
-            html_msg = message
-            full_msg.attach(MIMEText(html_msg, 'html'))
+        # Only this process's accounts: another shard's replies must not keep this lane busy
+        next_retry = min((due for chunk in chunked(accounts, HASH_LOOKUP_CHUNK)
+                          for (due,) in conn.execute(NEXT_REPLY_RETRY_SQL.format(placeholders=','.join('?' * len(chunk))),
+                                                     chunk) if due), default=None)
+    # inbox_store writes through the write queue, so only once this connection has committed
+    for inbox_account, in_reply_to in threads_replied:
+        inbox_store.mark_replied(inbox_account, in_reply_to)
+    return datetime.fromisoformat(next_retry) if next_retry else None
+
+def fail_orphaned_replies():
+    """Mark replies queued for an account that has since been removed as failed; nobody would send them."""
+    with get_connection() as conn:
+        cursor = conn.execute(ORPHANED_REPLIES_SQL)
+        conn.commit()
+    if cursor.rowcount:
+        print(f"[REPLY] Failed {cursor.rowcount} queued replies whose account was removed")
+    return cursor.rowcount
+
+# The earliest email planned for one account, and the first ones any account may take
+# (CLAIM_SQL's two conditions); the range on next_send_time skips NULLs
+SCHEDULER_PLANNED_SQL = '''SELECT MIN(next_send_time) FROM emails
+                           WHERE planned_account = ? AND sent_at IS NULL AND is_sending = 0
+                           AND next_send_time <= ?'''
+SCHEDULER_ANY_SQL = f'''SELECT next_send_time FROM emails
+                        WHERE sent_at IS NULL AND is_sending = 0
+                        AND {CLAIM_ANY} AND next_send_time <= ?
+                        ORDER BY next_send_time LIMIT ?'''
 
+class SendScheduler:
+    """Event-driven sender loop that replaces polling the queue every minute.
+
+    Keeps a heap of upcoming next_send_times and sleeps exactly until the earliest
+    one that also has an account ready to send it. notify() wakes it immediately,
+    e.g. when select_columns enqueues a new campaign.
+    """
+
+    def __init__(self, lookahead=SCHEDULER_LOOKAHEAD, max_sleep=SCHEDULER_MAX_SLEEP, poll=SCHEDULER_SIGNAL_POLL):
+        self.lookahead = lookahead
+        self.max_sleep = max_sleep
+        self.poll = poll
+        self._heap = []
+        self._cond = threading.Condition()
+        self._dirty = True  # heap needs reloading from the database
+        self._loaded_at = 0.0
+        self._signals = None  # last seen db.signals counters
+        self._replies_at = datetime.min  # when to next run the reply lane (None = nothing queued)
+        self._thread = None
+
+    def notify(self, due=None):
+        """Wake the scheduler; pass the due time of new work if known, else it resyncs."""
+        with self._cond:
+            if due is None:
+                self._dirty = True
+            else:
+                heapq.heappush(self._heap, (due, None))
+            self._cond.notify()
+
+    def notify_replies(self):
+        """Wake the scheduler to send queued replies ahead of any cold email."""
+        with self._cond:
+            self._replies_at = datetime.min
+            self._cond.notify()
+
+    def _reload(self):
+        # Only what this process's accounts can send: a prefix of the whole queue could
+        # be all another shard's (or a maxed-out account's) emails, hiding ours behind it
+        accounts = [account[1] for account in account_quotas.accounts(include_waiting=True)]
+        overdue = datetime.utcnow() - timedelta(hours=PLAN_REASSIGN_AFTER_HOURS)
+        with get_connection() as conn:
+            rows = [(conn.execute(SCHEDULER_PLANNED_SQL, (account, datetime.max)).fetchone()[0], account)
+                    for account in accounts]
+            rows += [(due, None) for (due,) in conn.execute(SCHEDULER_ANY_SQL, (overdue, datetime.max, self.lookahead))]
+        heap = [(datetime.fromisoformat(due), planned) for due, planned in rows if due]
+        heapq.heapify(heap)
+        with self._cond:
+            self._heap = heap
+            self._dirty = False
+        self._loaded_at = time.monotonic()
+
+    def _next_wake(self):
+        """Earliest time an email is due and an account is free to send it (None = nothing to do)."""
+        if not self._heap:
+            return None
+        accounts = account_quotas.accounts(include_waiting=True)
+        if not accounts:
+            return None
+        ready = {account[1]: account_quotas.ready_at(account) for account in accounts}
+        any_ready = min(ready.values())
+        reassign_after = timedelta(hours=PLAN_REASSIGN_AFTER_HOURS)
+
+        wake = None
+        for due, planned in sorted(self._heap):
+            if wake is not None and due >= wake:
+                break
+            if planned is None:
+                candidate = max(due, any_ready)
+            elif planned in ready:
+                candidate = max(due, ready[planned])
+            else:
+                # Planned account has no quota or is gone; any account may take it once overdue
+                candidate = max(due + reassign_after, any_ready)
+            wake = candidate if wake is None else min(wake, candidate)
+        return wake
+
+    def _check_signals(self):
+        """Pick up queue and account changes committed by other processes (e.g. the web process)."""
+        with get_connection() as conn:
+            signals = read_signals(conn)
+        if self._signals is not None:
+            if signals.get('accounts') != self._signals.get('accounts'):
+                account_quotas.reload()
+                self._dirty = True
+            if signals.get('replies') != self._signals.get('replies'):
+                self._replies_at = datetime.min
+            if signals.get('queue') != self._signals.get('queue'):
+                self._dirty = True
+                # Render the new campaign's first sends ahead of time
+                if scheduler.running:
+                    scheduler.add_job(prerender_due_emails, id='prerender_now', replace_existing=True)
+        self._signals = signals
+
+    def _run(self):
+        while True:
             try:
-                print(f"[SEND] Attempting to send to {to_email} using {account[1]} ({smtp_host}:{smtp_port})")
-                with smtplib.SMTP_SSL(smtp_host, smtp_port, timeout=10) as server:
-                    server.set_debuglevel(1)
-                    print("Connected. Logging in...")
-                    server.login(smtp_user, smtp_pass)
-                    print("Logged in.")
-                    server.send_message(full_msg)
-
-                conn.execute(
-                    "UPDATE emails SET sent_at=?, account_email=?, is_sending=0, message_id=? WHERE id=?",
-                    (now, account[1], msg_id, id_)
-                )
-                conn.execute("UPDATE accounts SET sent_today = sent_today + 1 WHERE id=?", (account[0],))
-                conn.commit()
-                print(f"[SUCCESS] Sent to {to_email}")
+                self._check_signals()
+                if self._replies_at is not None and self._replies_at <= datetime.utcnow():
+                    self._replies_at = send_queued_replies()
+                if self._dirty or time.monotonic() - self._loaded_at > self.max_sleep:
+                    self._reload()
+                    self._replies_at = self._replies_at or datetime.min
+                wake = self._next_wake()
+                now = datetime.utcnow()
+                if wake is None or wake > now:
+                    timeout = self.poll if wake is None else min((wake - now).total_seconds(), self.poll)
+                    with self._cond:
+                        if not self._dirty and self._replies_at != datetime.min:
+                            self._cond.wait(timeout)
+                    continue
+
+                dispatched = send_next_email()
+                self._dirty = True
+                if not dispatched:
+                    # Lost the race for the due emails (e.g. to another worker); back off briefly
+                    with self._cond:
+                        self._cond.wait(1)
             except Exception as e:
-                print(f"[ERROR] Failed to send to {to_email} via {account[1]}: {e}")
-                # Reset is_sending flag on error
-                conn.execute("UPDATE emails SET is_sending = 0 WHERE id = ?", (id_,))
-                conn.commit()
+                print(f"[SCHEDULER ERROR] {e}")
+                time.sleep(1)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='send-scheduler', daemon=True)
+            self._thread.start()
+
+send_scheduler = SendScheduler()
+
+MARK_OPENED_SQL = '''UPDATE emails SET opened=1, opened_at=?
+                     WHERE uid=? AND sent_at IS NOT NULL
+                     AND opened=0 AND campaign_id IS NOT NULL
+                     RETURNING campaign_id'''
+
+class OpenTracker:
+    """Write-behind recorder for tracking pixel hits.
+
+    The request thread only does an in-memory dedup check and a non-blocking put onto
+    a bounded queue; a background thread drains the queue and marks opens in batched
+    transactions so pixel traffic never waits on the database write lock.
+    """
+
+    def __init__(self, max_queue=OPEN_QUEUE_MAX, batch_size=OPEN_FLUSH_BATCH,
+                 flush_interval=OPEN_FLUSH_INTERVAL, dedup_size=OPEN_DEDUP_SIZE):
+        self.events = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dedup_size = dedup_size
+        self._seen = OrderedDict()  # recently queued uids, oldest first
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'queued': 0, 'deduped': 0, 'dropped': 0, 'flushed': 0}
+        self._thread = None
+
+    def record(self, uid):
+        with self._lock:
+            self.stats['hits'] += 1
+            if uid in self._seen:
+                self._seen.move_to_end(uid)
+                self.stats['deduped'] += 1
+                return
+            self._seen[uid] = True
+            if len(self._seen) > self.dedup_size:
+                self._seen.popitem(last=False)
+        try:
+            self.events.put_nowait((uid, datetime.utcnow()))
+            with self._lock:
+                self.stats['queued'] += 1
+        except queue.Full:
+            with self._lock:
+                self.stats['dropped'] += 1
+                # Forget the uid so a later hit can still be counted
+                self._seen.pop(uid, None)
+                dropped = self.stats['dropped']
+            if dropped == 1 or dropped % 1000 == 0:
+                print(f"[OPEN TRACKING] Queue full, dropped {dropped} open events so far")
+
+    @staticmethod
+    def _mark_opened(conn, batch):
+        # Only emails that were sent, belong to a campaign and aren't opened yet
+        opened_per_campaign = {}
+        for uid, opened_at in batch:
+            for (campaign_id,) in conn.execute(MARK_OPENED_SQL, (opened_at, uid)).fetchall():
+                opened_per_campaign[campaign_id] = opened_per_campaign.get(campaign_id, 0) + 1
+        for campaign_id, count in opened_per_campaign.items():
+            bump_campaign_stat(conn, campaign_id, 'opened', count)
+        return sum(opened_per_campaign.values())
+
+    def flush(self, batch):
+        """Mark a batch of (uid, opened_at) events as opened, committed with other queued writes."""
+        try:
+            updated = writer.submit(self._mark_opened, batch).result()
+        except Exception:
+            with self._lock:
+                # Nothing was recorded; forget the uids so later hits can still be counted
+                for uid, _ in batch:
+                    self._seen.pop(uid, None)
+            raise
+        with self._lock:
+            self.stats['flushed'] += updated
+        if updated:
+            print(f"[OPEN DETECTED] Marked {updated} emails as opened ({len(batch)} events)")
+
+    def _run(self):
+        while True:
+            batch = [self.events.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.events.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self.flush(batch)
+            except Exception as e:
+                print(f"[OPEN TRACKING ERROR] Failed to flush {len(batch)} open events: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='open-tracker', daemon=True)
+            self._thread.start()
+
+    def drain(self):
+        """Flush whatever is queued right now (used at shutdown)."""
+        batch = []
+        while True:
+            try:
+                batch.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self.flush(batch)
+
+open_tracker = OpenTracker()
+atexit.register(open_tracker.drain)
+registry.counter('pixel_hits_total', "Tracking pixel requests", callback=lambda: open_tracker.stats['hits'])
+registry.counter('pixel_hits_deduped_total', "Pixel hits for a uid seen recently", callback=lambda: open_tracker.stats['deduped'])
+registry.counter('pixel_events_dropped_total', "Open events dropped because the write queue was full",
+                 callback=lambda: open_tracker.stats['dropped'])
+registry.gauge('pixel_queue_depth', "Open events waiting to be written", callback=lambda: open_tracker.events.qsize())
 
 # (You can add 'account_email' field in the inbox/reply tracking if needed)
 @app.route('/pixel.gif')
 def tracking_pixel():
     uid = request.args.get('uid')
     if uid:
-        with sqlite3.connect(DB_PATH) as conn:
-            # Check if this email belongs to a campaign and hasn't been opened yet
-            cursor = conn.execute('''SELECT id, campaign_id FROM emails 
-                                  WHERE uid=? AND sent_at IS NOT NULL 
-                                  AND opened=0''', (uid,))
-            result = cursor.fetchone()
-            
-            if result:
-                email_id, campaign_id = result
-                # Only mark as opened if it belongs to a campaign
-                if campaign_id:
-                    conn.execute("UPDATE emails SET opened=1, opened_at=? WHERE id=?", 
-                               (datetime.utcnow(), email_id))
-                    conn.commit()
-                    print(f"[OPEN DETECTED] Email {email_id} from campaign {campaign_id} was opened")
-    return send_file(TRACKING_PIXEL_PATH, mimetype='image/gif')
+        open_tracker.record(uid)
+    return Response(PIXEL_BYTES, mimetype='image/gif')
+
+@app.route('/metrics')
+def metrics():
+    return Response(registry.render(), content_type=METRICS_CONTENT_TYPE)
 
 @app.route('/dashboard')
 def dashboard():
-    with sqlite3.connect(DB_PATH) as conn:
-        # Get all campaigns with their stats
+    with get_connection() as conn:
+        # Get all campaigns with their stats (maintained incrementally in campaign_stats)
         campaigns = conn.execute('''SELECT 
             c.id, c.name, c.created_at,
-            COUNT(e.id) as total,
-            SUM(CASE WHEN e.sent_at IS NOT NULL THEN 1 ELSE 0 END) as sent,
-            SUM(e.opened) as opened,
-            SUM(e.replied) as replied
+            COALESCE(s.total, 0) as total,
+            COALESCE(s.sent, 0) as sent,
+            COALESCE(s.opened, 0) as opened,
+            COALESCE(s.replied, 0) as replied,
+            c.projected_completion
             FROM campaigns c
-            LEFT JOIN emails e ON c.id = e.campaign_id
-            GROUP BY c.id
+            LEFT JOIN campaign_stats s ON c.id = s.campaign_id
             ORDER BY c.created_at DESC''').fetchall()
-        
-        # Get overall stats
-        total = conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0]
-        sent = conn.execute("SELECT COUNT(*) FROM emails WHERE sent_at IS NOT NULL").fetchone()[0]
-        opened = conn.execute("SELECT COUNT(*) FROM emails WHERE opened=1").fetchone()[0]
-        replied = conn.execute("SELECT COUNT(*) FROM emails WHERE replied=1").fetchone()[0]
+        # Recent CSV imports and their progress
+        imports = conn.execute('''SELECT id, kind, filename, status, rows_read, inserted, rejected, error
+                                  FROM import_jobs ORDER BY id DESC LIMIT 10''').fetchall()
+    
+    # Overall stats are the sum of the per-campaign counters
+    total = sum(campaign[3] for campaign in campaigns)
+    sent = sum(campaign[4] for campaign in campaigns)
+    opened = sum(campaign[5] for campaign in campaigns)
+    replied = sum(campaign[6] for campaign in campaigns)
     
     return render_template('dashboard.html', 
                          campaigns=campaigns,
+                         imports=imports,
                          total=total,
                          sent=sent,
                          opened=opened,
                          replied=replied)
 
-def background_inbox_fetch_parallel():
-    import sqlite3
-
-    with sqlite3.connect(DB_PATH) as conn:
-        accounts = conn.execute("SELECT imap_host, imap_port, imap_user, imap_pass FROM accounts").fetchall()
-    
-    def launch_all(accounts):
-        for host, port, user, pwd in accounts:
-            if user == "...":
-                threading.Thread(target=persistent_check_loop, args=(host, port, user, pwd), daemon=True).start()
-                break # just to try 1
-    
-    threading.Thread(target=launch_all, args=(accounts,), daemon=True).start()
+MESSAGE_ID_RE = re.compile(r'<[^<>\s]+>')
+FINAL_RECIPIENT_RE = re.compile(r'^(?:Final|Original)-Recipient:\s*rfc822\s*;\s*<?([^\s<>;]+@[^\s<>;]+)', re.I | re.M)
+BOUNCE_SENDERS = ('mailer-daemon', 'postmaster')
+header_parser = BytesHeaderParser()
 
 def parse_email_message(msg_data):
-    """Helper function to parse email message data into a structured format."""
-    from_, subject, message_id, references, body = '', '', '', '', ''
-    print(f"[EMAIL PARSING] Raw message data: {msg_data}")
-    
+    """Helper function to parse email message data into a structured format.
+
+    msg_data is one message's FETCH parts: the HEADER.FIELDS literal and a bounded
+    BODY[TEXT] prefix. Headers go through the stdlib bytes header parser and RFC 2047
+    encoded words are decoded. Raw payloads are never logged.
+    """
+    header_bytes, body_bytes = b'', b''
     for part in msg_data:
         if isinstance(part, tuple):
-            raw = part[1].decode(errors='ignore')
-            print(f"[EMAIL PARSING] Raw header part: {raw}")
-            
-            # Check each header separately
-            if 'From:' in raw:
-                from_ = parse_email_address(raw.split('From:')[-1].strip())
-                print(f"[EMAIL PARSING] Found From: {from_}")
-            
-            if 'Subject:' in raw:
-                subject = raw.split('Subject:')[-1].strip()
-                print(f"[EMAIL PARSING] Found Subject: {subject}")
-            
-            if 'Message-ID:' in raw:
-                message_id = raw.split('Message-ID:')[-1].strip()
-                if message_id:
-                    message_id = message_id.strip()
-                    if not message_id.startswith('<'):
-                        message_id = f"<{message_id}>"
-                    if not message_id.endswith('>'):
-                        message_id = f"{message_id}>"
-                print(f"[EMAIL PARSING] Found Message-ID: {message_id}")
-            
-            if 'References:' in raw:
-                references = raw.split('References:')[-1].strip()
-                print(f"[EMAIL PARSING] Found References header: {references}")
-                if references:
-                    # Extract only message IDs (text between < and >)
-                    refs = re.findall(r'<([^>]+)>', references)
-                    # Clean up each reference
-                    refs = [f"<{ref}>" if not ref.startswith('<') else ref for ref in refs]
-                    refs = [ref if ref.endswith('>') else f"{ref}>" for ref in refs]
-                    references = ' '.join(refs)
-                    print(f"[EMAIL PARSING] Processed References: {references}")
-                    print(f"[EMAIL PARSING] References list: {refs}")
-            
-            if not any(header in raw for header in ['From:', 'Subject:', 'Message-ID:', 'References:']):
-                body = raw.strip()
-                print(f"[EMAIL PARSING] Found body content")
-    
+            head = part[0].upper()
+            if b'HEADER.FIELDS' in head:
+                header_bytes = part[1]
+            elif b'BODY[TEXT]' in head:
+                body_bytes = part[1]
+
+    headers = header_parser.parsebytes(header_bytes)
+
+    def header(name):
+        value = headers.get(name) or ''
+        if '=?' not in value:
+            return ' '.join(value.split())
+        try:
+            return ' '.join(str(make_header(decode_header(value))).split())
+        except Exception:
+            # Malformed encoded word; fall back to the raw value
+            return ' '.join(value.split())
+
+    message_id = MESSAGE_ID_RE.search(header('Message-ID'))
+    message_id = message_id.group(0) if message_id else ''
+
+    # Reply candidates: everything in References plus In-Reply-To, in order, without repeats
+    refs = []
+    for ref in MESSAGE_ID_RE.findall(header('References')) + MESSAGE_ID_RE.findall(header('In-Reply-To')):
+        if ref not in refs:
+            refs.append(ref)
+
+    charset = headers.get_content_charset() or 'utf-8'
+    try:
+        body = body_bytes.decode(charset, errors='replace')
+    except LookupError:
+        body = body_bytes.decode('utf-8', errors='replace')
+
+    # Delivery status notifications: the failed recipients, as far as the body prefix shows them
+    sender = parse_email_address(header('From'))
+    bounced = None
+    if ((headers.get_content_type() == 'multipart/report'
+         and (headers.get_param('report-type') or '').lower() == 'delivery-status')
+            or sender.split('@')[0].lower() in BOUNCE_SENDERS):
+        bounced = FINAL_RECIPIENT_RE.findall(body)
+
     return {
-        'from': from_,
-        'subject': subject,
+        'from': sender,
+        'subject': header('Subject'),
         'message_id': message_id,
-        'references': references,
-        'body': body
+        'references': ' '.join(refs),
+        'date': header('Date'),
+        'body': body.strip(),
+        'bounced': bounced
     }
 
-def check_reply_tracking(references, from_):
-    """Helper function to check and update reply tracking."""
-    if not references:  # If no references, not a reply
-        return
-        
-    print(f"[REPLY TRACKING] Found references: {references}")
-    with sqlite3.connect(DB_PATH) as conn:
-        # Look up the original email by its message ID in the references
-        for ref in references.split():
-            ref = ref.strip('<>')  # Remove angle brackets
-            print(f"[REPLY TRACKING] Checking reference: {ref}")
-            print(f"[REPLY TRACKING] SQL Query: SELECT id, campaign_id FROM emails WHERE message_id=? AND sent_at IS NOT NULL AND replied=0")
-            print(f"[REPLY TRACKING] Query parameters: message_id={ref}")
-            cursor = conn.execute('''SELECT id, campaign_id FROM emails 
-                                  WHERE message_id=? AND sent_at IS NOT NULL 
-                                  AND replied=0''', (ref,))
-            result = cursor.fetchone()
-            if result:
-                email_id, campaign_id = result
-                print(f"[REPLY TRACKING] Found matching email: id={email_id}, campaign_id={campaign_id}")
-                # Mark the original email as replied
-                conn.execute('''UPDATE emails SET replied=1, replied_at=? 
-                              WHERE id=?''', (datetime.utcnow(), email_id))
-                conn.commit()
-                print(f"[REPLY DETECTED] Email {email_id} from campaign {campaign_id} was replied to by {from_}")
+def record_bounces(messages):
+    """Suppress the recipients of bounced emails, from DSN Final-Recipient fields or,
+    failing that, the emails a bounce references. Returns how many addresses were new."""
+    addresses = {address for message in messages for address in message['bounced']}
+    wanted = list({ref.strip('<>') for message in messages if not message['bounced']
+                   for ref in message['references'].split()})
+    with get_connection() as conn:
+        for i in range(0, len(wanted), REPLY_LOOKUP_CHUNK):
+            chunk = wanted[i:i + REPLY_LOOKUP_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            addresses.update(row[0] for row in conn.execute(
+                f"SELECT email FROM emails WHERE message_id IN ({placeholders})", chunk))
+    added = writer.submit(suppress_addresses, addresses, 'bounced').result()
+    if added:
+        print(f"[BOUNCE] Suppressed {added} bounced addresses")
+    return added
+
+REPLY_TRACKING_SQL = '''SELECT id, campaign_id, message_id, email FROM emails
+                        WHERE message_id IN ({placeholders}) AND sent_at IS NOT NULL
+                        AND replied=0'''
+
+def check_reply_tracking(messages):
+    """Mark sent emails as replied for a whole batch of parsed inbound messages.
+
+    All References/In-Reply-To IDs in the batch are resolved with chunked IN (...)
+    queries and every replied update is applied in a single write-queue transaction.
+    Returns the number of emails newly marked as replied.
+    """
+    # Our Message-IDs are stored without angle brackets
+    wanted = {ref.strip('<>') for message in messages for ref in message['references'].split()}
+    if not wanted:
+        return 0
+
+    with get_connection() as conn:
+        outstanding = {}  # message_id -> (email id, campaign id, lead address)
+        wanted = list(wanted)
+        for i in range(0, len(wanted), REPLY_LOOKUP_CHUNK):
+            chunk = wanted[i:i + REPLY_LOOKUP_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            for email_id, campaign_id, message_id, lead in conn.execute(
+                    REPLY_TRACKING_SQL.format(placeholders=placeholders), chunk):
+                outstanding[message_id] = (email_id, campaign_id, lead)
+        if not outstanding:
+            return 0
+
+        replied_at = datetime.utcnow()
+        replied_ids = set()
+        replied_per_campaign = {}
+        repliers = set()
+        for message in messages:
+            # The first reference that points at one of our emails is the one being answered
+            for ref in message['references'].split():
+                match = outstanding.get(ref.strip('<>'))
+                if match is None:
+                    continue
+                email_id, campaign_id, lead = match
+                # Leads who answered are taken out of every other campaign
+                repliers.update((lead, message['from']))
+                if email_id not in replied_ids:
+                    replied_ids.add(email_id)
+                    replied_per_campaign[campaign_id] = replied_per_campaign.get(campaign_id, 0) + 1
+                    print(f"[REPLY DETECTED] Email {email_id} from campaign {campaign_id} was replied to by {message['from']}")
                 break
-            else:
-                print(f"[REPLY TRACKING] No matching email found for reference: {ref}")
-                # Debug: Check if the email exists at all
-                cursor = conn.execute("SELECT id, message_id, sent_at FROM emails WHERE message_id=?", (ref,))
-                debug_result = cursor.fetchone()
-                if debug_result:
-                    print(f"[REPLY TRACKING DEBUG] Found email but not matching criteria: id={debug_result[0]}, message_id={debug_result[1]}, sent_at={debug_result[2]}")
-                else:
-                    print(f"[REPLY TRACKING DEBUG] No email found with message_id={ref}")
 
-def persistent_check_loop(host, port, user, pwd):
-    key = f"{user}@{host}:{port}"
-    print(f"[IDLE LOOP STARTED] {key} is now running in persistent IDLE mode.")
+    def mark_replied(conn):
+        conn.executemany("UPDATE emails SET replied=1, replied_at=? WHERE id=? AND replied=0",
+                         [(replied_at, email_id) for email_id in replied_ids])
+        for campaign_id, count in replied_per_campaign.items():
+            bump_campaign_stat(conn, campaign_id, 'replied', count)
+        suppress_addresses(conn, repliers, 'replied')
 
-    retry_delay = 10  # Initial retry delay in seconds
-    max_delay = 3600  # Max delay of 1 hour
+    writer.submit(mark_replied).result()
+    return len(replied_ids)
 
-    while True:
+FETCH_START_RE = re.compile(rb'^\d+ \(')
+FETCH_UID_RE = re.compile(rb'UID (\d+)')
+
+def split_fetch_response(data):
+    """Split a multi-message FETCH response into (uid, parts) pairs.
+
+    Each parts list has the same shape imaplib returns for a single-message fetch,
+    so it can be handed straight to parse_email_message.
+    """
+    grouped = []
+    for item in data:
+        if item is None:
+            continue
+        head = item[0] if isinstance(item, tuple) else item
+        if FETCH_START_RE.match(head) or not grouped:
+            grouped.append([])
+        grouped[-1].append(item)
+
+    messages = []
+    for parts in grouped:
+        uid = None
+        for part in parts:
+            match = FETCH_UID_RE.search(part[0] if isinstance(part, tuple) else part)
+            if match:
+                uid = int(match.group(1))
+                break
+        messages.append((uid, parts))
+    return messages
+
+def compress_uid_set(uids):
+    """Turn a sorted list of UIDs into an IMAP sequence set, e.g. [1, 2, 3, 7] -> '1:3,7'."""
+    ranges = []
+    start = prev = uids[0]
+    for uid in uids[1:]:
+        if uid != prev + 1:
+            ranges.append(f"{start}:{prev}" if start != prev else str(start))
+            start = uid
+        prev = uid
+    ranges.append(f"{start}:{prev}" if start != prev else str(start))
+    return ','.join(ranges)
+
+def load_sync_state(key):
+    """Return (uidvalidity, last_uid) recorded for a mailbox, or (None, 0) if never synced."""
+    with get_connection() as conn:
+        row = conn.execute("SELECT uidvalidity, last_uid FROM imap_sync_state WHERE account_key=?",
+                           (key,)).fetchone()
+    return row if row else (None, 0)
+
+def save_sync_state(key, uidvalidity, last_uid):
+    # Goes through the writer queue, so mailboxes syncing at once share commits
+    writer.execute('''INSERT INTO imap_sync_state (account_key, uidvalidity, last_uid, updated_at)
+                      VALUES (?, ?, ?, ?)
+                      ON CONFLICT(account_key) DO UPDATE SET
+                          uidvalidity=excluded.uidvalidity,
+                          last_uid=excluded.last_uid,
+                          updated_at=excluded.updated_at''',
+                   (key, uidvalidity, last_uid, datetime.utcnow())).result()
+
+def process_fetched_batch(key, uidvalidity, last_uid, data):
+    """Parsing/reply-tracking stage for one UID FETCH response; runs on the parse executor."""
+    new_messages = [(uid, parse_email_message(parts)) for uid, parts in split_fetch_response(data)]
+    # Bounces often quote our Message-ID too; they must not count as replies
+    bounces = [message for uid, message in new_messages if message['bounced'] is not None]
+    if bounces:
+        record_bounces(bounces)
+    check_reply_tracking([message for uid, message in new_messages if message['bounced'] is None])
+    inbox_store.add(key, uidvalidity, new_messages)
+    # Persist progress per batch so a dropped connection resumes where it stopped
+    save_sync_state(key, uidvalidity, last_uid)
+    return len(new_messages)
+
+def parse_received_at(date_header):
+    """Date header -> naive UTC datetime, falling back to now for missing or bad dates."""
+    try:
+        received = email.utils.parsedate_to_datetime(date_header)
+    except (TypeError, ValueError, IndexError):
+        return datetime.utcnow()
+    if received.tzinfo is not None:
+        received = received.astimezone(timezone.utc).replace(tzinfo=None)
+    return received
+
+class InboxStore:
+    """Synced inbox messages, persisted in inbox_messages with an LRU cache of recent ones."""
+
+    COLUMNS = "account_key, message_id, from_addr, subject, body, refs, received_at, replied_at"
+
+    def __init__(self, cache_size=INBOX_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # (account_key, message_id) -> message dict
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _to_message(row):
+        account_key, message_id, from_, subject, body, refs, received_at, replied_at = row
+        return {
+            'account': account_key,
+            # Messages without a Message-ID are stored under a synthetic uid: key
+            'message_id': message_id if message_id.startswith('<') else '',
+            'from': from_,
+            'subject': subject,
+            'body': body,
+            'references': refs,
+            'received_at': received_at,
+            'replied_at': replied_at
+        }
+
+    def _remember(self, message):
+        with self._lock:
+            cache_key = (message['account'], message['message_id'])
+            self._cache[cache_key] = message
+            self._cache.move_to_end(cache_key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def add(self, key, uidvalidity, messages):
+        """Persist a batch of (uid, parsed message) pairs for one mailbox in one transaction."""
+        rows = []
+        for uid, message in messages:
+            stored_id = message['message_id'] or f"uid:{uidvalidity}:{uid}"
+            rows.append((key, stored_id, uid, message['from'], message['subject'], message['body'],
+                         message['references'], message['date'], parse_received_at(message['date'])))
+        with get_connection() as conn:
+            conn.executemany('''INSERT OR IGNORE INTO inbox_messages
+                                (account_key, message_id, uid, from_addr, subject, body, refs, date_header, received_at)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+            conn.commit()
+        for row in rows:
+            self._remember(self._to_message(row[:2] + row[3:7] + (row[8], None)))
+
+    def get(self, account_key, message_id):
+        with self._lock:
+            message = self._cache.get((account_key, message_id))
+        if message is not None:
+            return message
+        with get_connection() as conn:
+            row = conn.execute(f"SELECT {self.COLUMNS} FROM inbox_messages WHERE account_key=? AND message_id=?",
+                               (account_key, message_id)).fetchone()
+        if row is None:
+            return None
+        message = self._to_message(row)
+        self._remember(message)
+        return message
+
+    def page(self, account=None, status=None, since=None, page=1, page_size=INBOX_PAGE_SIZE):
+        """Return (messages, has_next) for one newest-first page of the filtered inbox."""
+        where, params = [], []
+        if account:
+            where.append("account_key = ?")
+            params.append(account)
+        if status == 'replied':
+            where.append("replied_at IS NOT NULL")
+        elif status == 'unreplied':
+            where.append("replied_at IS NULL")
+        if since:
+            where.append("received_at >= ?")
+            params.append(since)
+        sql = f"SELECT {self.COLUMNS} FROM inbox_messages"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY received_at DESC, id DESC LIMIT ? OFFSET ?"
+        params += [page_size + 1, (page - 1) * page_size]
+        with get_connection() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [self._to_message(row) for row in rows[:page_size]], len(rows) > page_size
+
+    def mark_replied(self, account_key, message_id):
+        replied_at = datetime.utcnow()
+        writer.execute("UPDATE inbox_messages SET replied_at=? WHERE account_key=? AND message_id=?",
+                       (replied_at, account_key, message_id)).result()
+        with self._lock:
+            message = self._cache.get((account_key, message_id))
+            if message is not None:
+                message['replied_at'] = replied_at
+
+    def accounts(self):
+        with get_connection() as conn:
+            return [row[0] for row in conn.execute("SELECT account_key FROM imap_sync_state ORDER BY account_key")]
+
+inbox_store = InboxStore()
+
+class IMAPError(Exception):
+    pass
+
+class AsyncIMAPClient:
+    """Just enough IMAP4rev1 over asyncio streams for incremental sync and IDLE.
+
+    Untagged responses are collected in the same shape imaplib uses (literals come
+    back as (header, bytes) tuples), so the imaplib-oriented helpers above still apply.
+    """
+
+    LITERAL_RE = re.compile(rb'\{(\d+)\}\r\n$')
+    UNTAGGED_RE = re.compile(rb'^(?:(\d+) )?([A-Z-]+)(?: (.*))?$', re.S)
+    UIDVALIDITY_RE = re.compile(rb'\[UIDVALIDITY (\d+)\]')
+
+    def __init__(self, host, port, debug=False):
+        self.host = host
+        self.port = port
+        self.debug = debug  # print the protocol conversation (accounts.protocol_debug)
+        self.reader = None
+        self.writer = None
+        self.untagged = {}
+        self._tag_number = 0
+
+    async def connect(self):
+        ssl_context = ssl.create_default_context() if IMAP_USE_SSL else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=ssl_context, limit=IMAP_LINE_LIMIT), IMAP_TIMEOUT)
+        greeting = await self._readline()
+        if not greeting.startswith(b'* OK'):
+            raise IMAPError(f"unexpected greeting: {greeting!r}")
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _readline(self, timeout=IMAP_TIMEOUT):
+        line = await asyncio.wait_for(self.reader.readline(), timeout)
+        if not line:
+            raise ConnectionError("connection closed by server")
+        if self.debug:
+            print(f"[IMAP {self.host}] S: {line.rstrip()!r}")
+        return line
+
+    def _next_tag(self):
+        self._tag_number += 1
+        return f"A{self._tag_number:04d}".encode()
+
+    async def _send(self, line):
+        if self.debug:
+            print(f"[IMAP {self.host}] C: {line!r}")
+        self.writer.write(line + b'\r\n')
+        await self.writer.drain()
+
+    async def _collect_untagged(self, line):
+        # Read the rest of the response, pulling in any {n} literals
+        pieces = []
+        rest = line[2:]
+        while True:
+            match = self.LITERAL_RE.search(rest)
+            if not match:
+                pieces.append(rest.rstrip(b'\r\n'))
+                break
+            literal = await asyncio.wait_for(self.reader.readexactly(int(match.group(1))), IMAP_TIMEOUT)
+            pieces.append((rest[:-2], literal))
+            rest = await self._readline()
+
+        first = pieces[0][0] if isinstance(pieces[0], tuple) else pieces[0]
+        match = self.UNTAGGED_RE.match(first)
+        if not match:
+            return
+        number, typ, data = match.groups()
+        typ = typ.decode().upper()
+        data = data or b''
+        if number is not None:
+            data = number + b' ' + data
+        if isinstance(pieces[0], tuple):
+            pieces[0] = (data, pieces[0][1])
+        else:
+            pieces[0] = data
+        self.untagged.setdefault(typ, []).extend(pieces)
+
+        validity = self.UIDVALIDITY_RE.search(first)
+        if validity:
+            self.untagged['UIDVALIDITY'] = [validity.group(1)]
+
+    async def command(self, *args):
+        tag = self._next_tag()
+        self.untagged = {}
+        await self._send(tag + b' ' + b' '.join(a if isinstance(a, bytes) else a.encode() for a in args))
+        while True:
+            line = await self._readline()
+            if line.startswith(tag + b' '):
+                status = line.split(b' ', 2)[1].decode().upper()
+                if status != 'OK':
+                    raise IMAPError(line.decode(errors='replace').strip())
+                return status
+            if line.startswith(b'* '):
+                await self._collect_untagged(line)
+
+    async def login(self, user, pwd):
+        quote = lambda value: '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        return await self.command('LOGIN', quote(user), quote(pwd))
+
+    async def select(self, mailbox='INBOX'):
+        """Select a mailbox and return its UIDVALIDITY."""
+        await self.command('SELECT', mailbox)
+        return int(self.untagged['UIDVALIDITY'][0])
+
+    async def uid(self, command, *args):
+        status = await self.command('UID', command, *args)
+        return status, self.untagged.get(command.upper(), [b''])
+
+    async def idle(self, timeout):
+        """IDLE until the server reports new mail or timeout expires. Returns True on new mail."""
+        tag = self._next_tag()
+        await self._send(tag + b' IDLE')
+        if not (await self._readline()).startswith(b'+'):
+            raise IMAPError("IDLE not acknowledged")
+
+        new_mail = False
+        deadline = time.monotonic() + timeout
         try:
-            with imaplib.IMAP4_SSL(host, port) as mail:
-                mail.debug = 4
-                mail.login(user, pwd)
-                mail.select("inbox")
-                status, folders = mail.list()
-                for folder in folders:
-                    print(folder.decode())
+            while not new_mail:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                line = await self._readline(timeout=remaining)
+                new_mail = line.startswith(b'* ') and line.rstrip().upper().endswith(b'EXISTS')
+        except asyncio.TimeoutError:
+            pass
+
+        await self._send(b'DONE')
+        while not (await self._readline()).startswith(tag + b' '):
+            pass
+        return new_mail
+
+IMAP_CONNECTS = registry.counter('imap_connects_total', "IMAP sessions opened", ['account'])
+IMAP_RECONNECTS = registry.counter('imap_reconnects_total', "IMAP sessions lost to an error and retried", ['account'])
+IMAP_FETCH_SECONDS = registry.histogram('imap_fetch_seconds', "Time for one batched UID FETCH", ['account'])
+IMAP_MESSAGES_SYNCED = registry.counter('imap_messages_synced_total', "Messages fetched and stored", ['account'])
+
+class IMAPSupervisor:
+    """Watches every account's inbox from a single asyncio event loop.
+
+    Each mailbox gets one coroutine that catches up with an incremental sync, then
+    sits in IDLE (re-armed every IMAP_IDLE_SECONDS) and syncs again when new mail
+    arrives. Parsing and reply tracking run on a small thread pool so the loop
+    itself only does network I/O. Failures back off per account.
+    """
+
+    def __init__(self, parse_workers=IMAP_PARSE_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=parse_workers, thread_name_prefix='inbox-parse')
+        self.watchers = {}  # account key -> asyncio.Task
+        self.loop = None
+        self._thread = None
+
+    async def _in_executor(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def sync_new_messages(self, client, key, uidvalidity):
+        """Fetch only messages newer than the stored high-water mark, in batched UID FETCH commands."""
+        stored_validity, last_uid = await self._in_executor(load_sync_state, key)
+        if stored_validity != uidvalidity:
+            if stored_validity is not None:
+                print(f"[SYNC] {key} UIDVALIDITY changed ({stored_validity} -> {uidvalidity}), resyncing")
+            last_uid = 0
+
+        # "n:*" always matches the newest message, even when its UID is below n
+        typ, data = await client.uid('SEARCH', f'UID {last_uid + 1}:*')
+        uids = sorted(int(uid) for uid in data[0].split() if int(uid) > last_uid)
+
+        synced = 0
+        for i in range(0, len(uids), IMAP_FETCH_BATCH):
+            batch = uids[i:i + IMAP_FETCH_BATCH]
+            with IMAP_FETCH_SECONDS.time(account=key):
+                typ, data = await client.uid('FETCH', compress_uid_set(batch), IMAP_FETCH_ITEMS)
+            synced += await self._in_executor(process_fetched_batch, key, uidvalidity, batch[-1], data)
+        IMAP_MESSAGES_SYNCED.inc(synced, account=key)
+
+        if not uids and stored_validity != uidvalidity:
+            await self._in_executor(save_sync_state, key, uidvalidity, last_uid)
+        return synced
+
+    async def watch(self, host, port, user, pwd, debug=False):
+        key = f"{user}@{host}:{port}"
+        print(f"[IDLE LOOP STARTED] {key} is now running in persistent IDLE mode.")
+        retry_delay = IMAP_RETRY_INITIAL
+
+        while True:
+            client = AsyncIMAPClient(host, port, debug)
+            try:
+                await client.connect()
+                await client.login(user, pwd)
+                IMAP_CONNECTS.inc(account=key)
+                uidvalidity = await client.select('INBOX')
                 # Reset retry delay on successful connection
-                retry_delay = 60
-
-                # Initially load all messages
-                typ, data = mail.search(None, 'ALL')
-                messages = []
-                for num in data[0].split():
-                    typ, msg_data = mail.fetch(num, '(BODY[HEADER.FIELDS (FROM SUBJECT MESSAGE-ID REFERENCES)] BODY[TEXT])')
-                    message = parse_email_message(msg_data)
-                    check_reply_tracking(message['references'], message['from'])
-                    messages.append(message)
-                    
-                per_account_messages[key] = messages
-                print(f"[INITIAL LOAD] {key} → {len(messages)} messages")
+                retry_delay = IMAP_RETRY_INITIAL
 
-                try:
-                    while True:
-                        print(f"[IDLE] {key} entering IDLE...")
-                        tag = mail._new_tag()
-                        mail.send(f"{tag} IDLE\r\n".encode())
-
-                        if not mail.readline().startswith(b'+'):
-                            raise Exception("IDLE not acknowledged")
-
-                        if select.select([mail.sock], [], [], 1740)[0]:
-                            print(f"[IDLE] {key} change detected!")
-                            mail.send(b"DONE\r\n")
-
-                            # Read until DONE acknowledged
-                            while True:
-                                line = mail.readline()
-                                if b"Idle completed" in line:
-                                    break
-
-                            time.sleep(0.2)
-
-                            # Reload all messages when changes detected
-                            typ, data = mail.search(None, 'UNSEEN')
-                            new_messages = []
-                            for num in data[0].split():
-                                typ, msg_data = mail.fetch(num, '(BODY[HEADER.FIELDS (FROM SUBJECT MESSAGE-ID REFERENCES)] BODY[TEXT])')
-                                message = parse_email_message(msg_data)
-                                check_reply_tracking(message['references'], message['from'])
-                                new_messages.append(message)
-
-                            # Only add messages that aren't already in the list
-                            existing_message_ids = {msg['message_id'] for msg in per_account_messages[key]}
-                            for msg in new_messages:
-                                if msg['message_id'] not in existing_message_ids:
-                                    per_account_messages[key].append(msg)
-                            print(f"[IDLE] {key} → Added {len(new_messages)} new messages")
-
-                        else:
-                            # IDLE timed out (29 mins), flush DONE
-                            mail.send(b"DONE\r\n")
-                            while True:
-                                line = mail.readline()
-                                if b"Idle completed" in line:
-                                    break
-
-                except Exception as e_inner:
-                    print(f"[IDLE INNER ERROR] {key} loop error: {e_inner}")
-                    raise
+                # Catch up on everything that arrived since the last sync
+                synced = await self.sync_new_messages(client, key, uidvalidity)
+                print(f"[INITIAL LOAD] {key} → {synced} new messages")
+
+                while True:
+                    if await client.idle(IMAP_IDLE_SECONDS):
+                        synced = await self.sync_new_messages(client, key, uidvalidity)
+                        print(f"[IDLE] {key} → Added {synced} new messages")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[IDLE ERROR] {key}: {e!r}")
+                IMAP_RECONNECTS.inc(account=key)
+                print(f"[IDLE] {key} sleeping for {retry_delay} seconds before retry...")
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, IMAP_RETRY_MAX)
+            finally:
+                await client.close()
+
+    def _load_accounts(self):
+        with get_connection() as conn:
+            return [row[1:] for row in conn.execute("SELECT email, imap_host, imap_port, imap_user, imap_pass, protocol_debug FROM accounts")
+                    if owns_account(row[0])]
 
-        except Exception as e_outer:
-            print(f"[IDLE ERROR] {key} failed to connect or login: {e_outer}")
-            print(f"[IDLE] {key} sleeping for {retry_delay} seconds before retry...")
-            time.sleep(retry_delay)
-            retry_delay = min(retry_delay * 2, max_delay)
+    async def refresh_accounts(self):
+        """Start a watcher for every new account and stop watchers for removed ones."""
+        accounts = await self._in_executor(self._load_accounts)
+        wanted = {f"{user}@{host}:{port}": (host, port, user, pwd, bool(debug)) for host, port, user, pwd, debug in accounts}
+        for key, task in list(self.watchers.items()):
+            if key not in wanted or task.done():
+                task.cancel()
+                del self.watchers[key]
+        for key, account in wanted.items():
+            if key not in self.watchers:
+                self.watchers[key] = asyncio.create_task(self.watch(*account))
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await self.refresh_accounts()
+            except Exception as e:
+                print(f"[IDLE ERROR] Failed to load accounts: {e}")
+            await asyncio.sleep(IMAP_ACCOUNT_REFRESH_SECONDS)
+
+    def start(self):
+        """Run the supervisor's event loop on one background thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=asyncio.run, args=(self.run(),), name='inbox-sync', daemon=True)
+            self._thread.start()
+
+inbox_supervisor = IMAPSupervisor()
+
+def background_inbox_fetch_parallel():
+    """Start watching every account's inbox (one event loop for all of them)."""
+    inbox_supervisor.start()
 
 @app.route('/inbox')
 def inbox():
-    print("[INBOX] Merging messages from all inboxes...")
-    merged = []
-    print(per_account_messages)
-    for batch in per_account_messages.values():
-        merged.extend(batch)
-    print(f"[INBOX] Returning {len(merged)} cached messages")
-    return render_template('inbox.html', messages=merged)
+    account = request.args.get('account') or None
+    status = request.args.get('status') or None
+    page = max(request.args.get('page', 1, type=int), 1)
+    since = request.args.get('since') or None
+    try:
+        since_date = datetime.strptime(since, '%Y-%m-%d') if since else None
+    except ValueError:
+        since, since_date = None, None
+
+    messages, has_next = inbox_store.page(account, status, since_date, page)
+    with get_connection() as conn:
+        replies = reply_statuses(conn, messages)
+    return render_template('inbox.html', messages=messages, accounts=inbox_store.accounts(), replies=replies,
+                           account=account, status=status, since=since, page=page, has_next=has_next)
 
     
+def reply_account(conn, account_key, references):
+    """The accounts row a reply goes out from: the account that sent our email in the
+    thread, else the account whose inbox received the message (None if neither is known)."""
+    # Our Message-IDs are stored without angle brackets
+    ids = [ref.strip('<>') for ref in references][-REPLY_LOOKUP_CHUNK:]
+    if ids:
+        row = conn.execute(f'''SELECT a.* FROM emails e JOIN accounts a ON a.email = e.account_email
+                               WHERE e.message_id IN ({','.join('?' * len(ids))}) AND e.sent_at IS NOT NULL
+                               ORDER BY e.sent_at DESC LIMIT 1''', ids).fetchone()
+        if row:
+            return row
+    if account_key:
+        # Inbox accounts are keyed f"{imap_user}@{imap_host}:{imap_port}" (see IMAPSupervisor)
+        user, _, address = account_key.rpartition('@')
+        host, _, port = address.rpartition(':')
+        return conn.execute("SELECT * FROM accounts WHERE imap_user=? AND imap_host=? AND imap_port=?",
+                            (user, host, int(port) if port.isdigit() else port)).fetchone()
+    return None
+
+REPLY_STATUSES_SQL = '''SELECT inbox_account, in_reply_to, status, error FROM outbound_replies
+                        WHERE in_reply_to IN ({placeholders}) ORDER BY id'''
+
+def reply_statuses(conn, messages):
+    """Latest queued reply to each message shown: {(inbox account, message id): (status, error)}."""
+    ids = list({message['message_id'] for message in messages if message['message_id']})
+    statuses = {}
+    for chunk in chunked(ids, REPLY_LOOKUP_CHUNK):
+        for inbox_account, in_reply_to, status, error in conn.execute(
+                REPLY_STATUSES_SQL.format(placeholders=','.join('?' * len(chunk))), chunk):
+            statuses[(inbox_account, in_reply_to)] = (status, error)
+    return statuses
+
 @app.route('/reply', methods=['POST'])
 def reply():
+    """Queue a reply on the sender's priority lane (see send_queued_replies) and return straight away."""
     try:
-        print("[REPLY] Starting reply process...")
         to_email = parse_email_address(request.form['to'])  # Use the helper function
         body = request.form['body']
         original_subject = request.form.get('subject', '').split('\r\n')[0].strip()  # Get first line only
-        
-        print(f"[REPLY] Sending to: {to_email}")
-        print(f"[REPLY] Subject: {original_subject}")
-        
-        # Get an available account for sending
-        account = get_available_account()
-        if not account:
-            print("[REPLY] No available accounts found")
-            return "No available email accounts. Please try again later.", 503
-            
-        print(f"[REPLY] Using account: {account[1]}")
-            
-        # Create the email message
-        msg = MIMEMultipart()
-        msg['From'] = account[1]  # email
-        msg['To'] = to_email
-        
-        # Set proper threading headers
-        msg_id = f"{uuid.uuid4()}@{account[1].split('@')[1]}"
-        msg['Message-ID'] = f"<{msg_id}>"
-        
+
         # Clean up message ID and references
+        account_key = request.form.get('account', '')
         in_reply_to = request.form.get('message_id', '').split('\r\n')[0].strip()
         references = request.form.get('references', '').split('\r\n')[0].strip()
-        
+        original_body = request.form.get('original_body', '')
+
+        # Prefer the synced copy of the message over the hidden form fields
+        original = inbox_store.get(account_key, in_reply_to) if account_key and in_reply_to else None
+        if original:
+            references = original['references'] or references
+            original_body = original['body'] or original_body
+
         # Ensure Message-ID is properly formatted
         if in_reply_to and not in_reply_to.startswith('<'):
             in_reply_to = f"<{in_reply_to}>"
-        
-        # Build References header
-        if in_reply_to:
-            msg['In-Reply-To'] = in_reply_to
-            print(f"[REPLY] In-Reply-To: {in_reply_to}")
-            
-            # Combine References with In-Reply-To
-            if references:
-                # Split references into individual message IDs
-                refs = [ref.strip() for ref in references.split()]
-                # Clean up each reference
-                refs = [f"<{ref}>" if not ref.startswith('<') else ref for ref in refs]
-                refs = [ref if ref.endswith('>') else f"{ref}>" for ref in refs]
-                # Remove any non-message-id content
-                refs = [ref for ref in refs if ref.startswith('<') and ref.endswith('>')]
-                # Add the current In-Reply-To if not already in references
-                if in_reply_to not in refs:
-                    refs.append(in_reply_to)
+
+        # Split references into individual message IDs and clean up each one
+        refs = [ref.strip() for ref in references.split()]
+        refs = [f"<{ref}>" if not ref.startswith('<') else ref for ref in refs]
+        refs = [ref if ref.endswith('>') else f"{ref}>" for ref in refs]
+        # Remove any non-message-id content
+        refs = [ref for ref in refs if ref.startswith('<') and ref.endswith('>')]
+        # Add the current In-Reply-To if not already in references
+        if in_reply_to and in_reply_to not in refs:
+            refs.append(in_reply_to)
+
+        with get_connection() as conn:
+            # Reply from the account that owns the thread
+            account = reply_account(conn, account_key, refs)
+            if not account:
+                print(f"[REPLY] No sending account found for {account_key or to_email}")
+                return "No email account found for this conversation.", 503
+
+            # Create the email message
+            msg = MIMEMultipart()
+            msg['From'] = account[1]  # email
+            msg['To'] = to_email
+
+            # Set proper threading headers
+            msg_id = f"{uuid.uuid4()}@{account[1].split('@')[1]}"
+            msg['Message-ID'] = f"<{msg_id}>"
+            if in_reply_to:
+                msg['In-Reply-To'] = in_reply_to
                 msg['References'] = ' '.join(refs)
+
+            # Set subject with proper threading
+            if original_subject:
+                if not original_subject.startswith('Re:'):
+                    msg['Subject'] = f"Re: {original_subject}"
+                else:
+                    msg['Subject'] = original_subject
             else:
-                msg['References'] = in_reply_to
-            print(f"[REPLY] References: {msg['References']}")
-        
-        # Set subject with proper threading
-        if original_subject:
-            if not original_subject.startswith('Re:'):
-                msg['Subject'] = f"Re: {original_subject}"
+                msg['Subject'] = 'Re: Follow-up'
+
+            # Create the reply body with original message quoted
+            if original_body:
+                quoted_body = f"\n\nOn {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, {to_email} wrote:\n> " + original_body.replace('\n', '\n> ')
+                full_body = body + quoted_body
             else:
-                msg['Subject'] = original_subject
-        else:
-            msg['Subject'] = 'Re: Follow-up'
-        
-        # Create the reply body with original message quoted
-        original_body = request.form.get('original_body', '')
-        if original_body:
-            quoted_body = f"\n\nOn {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, {to_email} wrote:\n> " + original_body.replace('\n', '\n> ')
-            full_body = body + quoted_body
-        else:
-            full_body = body
-            
-        msg.attach(MIMEText(full_body, 'plain'))
-        
-        print("[REPLY] Attempting to send email...")
-        # Send the email
-        with smtplib.SMTP_SSL(account[2], account[3], timeout=10) as server:  # smtp_host, smtp_port
-            print(f"[REPLY] Connected to SMTP server {account[2]}:{account[3]}")
-            server.login(account[4], account[5])  # smtp_user, smtp_pass
-            print("[REPLY] Successfully logged in to SMTP server")
-            server.send_message(msg)
-            print("[REPLY] Email sent successfully")
-            
-        print("[REPLY] Updating database...")
-        # Update account usage
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.execute("UPDATE accounts SET sent_today = sent_today + 1 WHERE id=?", (account[0],))
+                full_body = body
+
+            msg.attach(MIMEText(full_body, 'plain'))
+            # Stored as sent: smtplib only fixes line endings of str messages, and many
+            # servers refuse bare LFs
+            message = msg.as_bytes(policy=msg.policy.clone(linesep='\r\n'))
+
+            conn.execute('''INSERT INTO outbound_replies (account_email, to_addr, message, message_id, inbox_account,
+                                                         in_reply_to, next_attempt_at)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                         (account[1], to_email, message, msg_id, account_key or None, in_reply_to or None,
+                          datetime.utcnow()))
+            # Wake the sender, in this or another process
+            bump_signal(conn, 'replies')
             conn.commit()
-            print(f"[REPLY] Updated sent_today count for account {account[0]}")
-            
-        print("[REPLY] Reply process completed successfully")
-        return redirect('/inbox')
+        send_scheduler.notify_replies()
+        print(f"[REPLY] Queued reply to {to_email} from {account[1]}")
+        return redirect(url_for('inbox', account=account_key or None))
     except Exception as e:
-        print(f"[REPLY ERROR] Failed to send reply: {e}")
+        print(f"[REPLY ERROR] Failed to queue reply: {e}")
         print(f"[REPLY ERROR] Full error details: {traceback.format_exc()}")
-        return f"Failed to send reply: {str(e)}", 500
+        return f"Failed to queue reply: {str(e)}", 500
 
 def parse_email_address(addr_str):
     """Parse an email address string into a clean email address."""
@@ -671,12 +2495,108 @@ def parse_email_address(addr_str):
     except:
         return addr_str.strip()
 
-if __name__ == '__main__':
-    # Start scheduler job
-    scheduler.add_job(send_next_email, 'interval', minutes=1, id='send_task')
-    send_next_email()
-    background_inbox_fetch_parallel()  # Only run once
-    app.run()
-    # Clean shutdown
+# The statements on the hot paths, checked by `python db.py` to be answered from an
+# index rather than a table scan; ({placeholders} lists get two values)
+HOT_QUERIES = {
+    'mark_opened': MARK_OPENED_SQL,
+    'reply_tracking': REPLY_TRACKING_SQL,
+    'claim_planned_email': CLAIM_SQL.format(condition=CLAIM_PLANNED),
+    'claim_ready_email': CLAIM_SQL.format(condition=CLAIM_ANY),
+    'prerender_due_emails': PRERENDER_SQL,
+    'scheduler_planned': SCHEDULER_PLANNED_SQL,
+    'scheduler_any': SCHEDULER_ANY_SQL,
+    'queued_hashes': QUEUED_HASHES_SQL,
+    'queued_hashes_in_campaign': QUEUED_IN_CAMPAIGN_SQL,
+    'reap_expired_leases': REAP_EMAILS_SQL,
+    'reap_expired_replies': REAP_REPLIES_SQL,
+    'claim_queued_replies': REPLY_CLAIM_SQL,
+    'next_reply_retry': NEXT_REPLY_RETRY_SQL,
+    'orphaned_replies': ORPHANED_REPLIES_SQL,
+    'reply_statuses': REPLY_STATUSES_SQL,
+}
+
+def start_sender():
+    register_quota_metrics()
+    send_scheduler.start()
+    scheduler.add_job(reap_expired_leases, 'interval', minutes=1, id='lease_reaper')
+    scheduler.add_job(fail_orphaned_replies, 'interval', minutes=1, id='orphaned_replies')
+    scheduler.add_job(account_quotas.flush, 'interval', seconds=QUOTA_FLUSH_SECONDS, id='quota_flush')
+    scheduler.add_job(prerender_due_emails, 'interval', seconds=RENDER_INTERVAL_SECONDS, id='prerender',
+                      next_run_time=datetime.now())
+    scheduler.start()
     atexit.register(lambda: scheduler.shutdown(wait=False))
 
+def start_web():
+    open_tracker.start()
+    scheduler.add_job(resume_import_jobs, 'interval', seconds=IMPORT_LEASE_SECONDS, id='import_resume',
+                      next_run_time=datetime.now())
+    if not scheduler.running:
+        scheduler.start()
+        atexit.register(lambda: scheduler.shutdown(wait=False))
+
+def wait_forever():
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+def run_web(host=None, port=None):
+    """Dashboard, uploads, import jobs and the tracking pixel; sends nothing itself."""
+    start_web()
+    app.run(host, port)
+
+def run_sender(metrics_port=None):
+    """Send loop for this shard's accounts (see owns_account)."""
+    start_sender()
+    if metrics_port:
+        registry.serve(metrics_port)
+    wait_forever()
+
+def run_inbox_sync(metrics_port=None):
+    """IMAP watchers for this shard's accounts."""
+    background_inbox_fetch_parallel()
+    if metrics_port:
+        registry.serve(metrics_port)
+    wait_forever()
+
+def run_all(host=None, port=None):
+    """Everything in one process, as a single-box install runs it."""
+    start_sender()
+    start_web()
+    background_inbox_fetch_parallel()
+    app.run(host, port)
+
+ROLES = {
+    'all': run_all,
+    'web': run_web,
+    'sender': run_sender,
+    'inbox-sync': run_inbox_sync,
+}
+
+if __name__ == '__main__':
+    # python main.py [all|web|sender|inbox-sync] [--shard I --shards N]
+    #
+    # The roles share only the database, so they can run as separate processes (or
+    # machines sharing the volume). Run N senders / inbox-sync workers with
+    # --shard 0..N-1 --shards N; each takes a fixed slice of the accounts table.
+    parser = argparse.ArgumentParser(description="Auto Cold Emailer")
+    parser.add_argument('role', nargs='?', default='all', choices=list(ROLES))
+    parser.add_argument('--shard', type=int, default=0, help="this worker's shard index")
+    parser.add_argument('--shards', type=int, default=1, help="number of sender/inbox-sync workers")
+    parser.add_argument('--host', default=None)
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="serve /metrics on this port (sender and inbox-sync; web serves it itself)")
+    args = parser.parse_args()
+
+    if args.role in ('web', 'all') and (args.shards > 1 or args.metrics_port):
+        parser.error(f"--shards and --metrics-port apply to sender and inbox-sync, not {args.role}")
+    try:
+        set_shard(args.shard, args.shards)
+    except ValueError as e:
+        parser.error(str(e))
+    init_db()
+    if args.role in ('web', 'all'):
+        ROLES[args.role](args.host, args.port)
+    else:
+        ROLES[args.role](args.metrics_port)